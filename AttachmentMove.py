@@ -1,626 +1,3608 @@
-#!/usr/bin/env python
-# -*- coding: utf-8 -*-
-# vim: et sw=4 ts=4 sts=4:
-#
-# This script is opensource and can be found here:
-# https://github.com/Sylvain303/mailman-AttachmentMove
-#
-# Copyright (C) 2001-2011 by the Free Software Foundation, Inc.
-#
-# This program is free software; you can redistribute it and/or
-# modify it under the terms of the GNU General Public License
-# as published by the Free Software Foundation; either version 2
-# of the License, or (at your option) any later version.
-#
-# This program is distributed in the hope that it will be useful,
-# but WITHOUT ANY WARRANTY; without even the implied warranty of
-# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-# GNU General Public License for more details.
-#
-# You should have received a copy of the GNU General Public License
-# along with this program; if not, write to the Free Software
-# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301,
-# USA.
-
-""" Mail attachment detach filter
-
-The detached parts are stored as attachment on the list archive. But the 
-attachment used is a fresh copy, uploaded to a remote location given by the
-extra required parameters:
-
-mlist.ftp_remote_host = 'ftp.example.com'
-mlist.ftp_remote_login = 'username'
-mlist.ftp_remote_pass = 'secr3te'
-# put the ending slash /
-mlist.remote_http_base = 'http://example.com/root/for/username/'
-
-# optional, a prefix on the remote storage:
-mlist.ftp_upload_prefix = 'listname_or_dev_'
-# optional, a folder on the remote storage. Not used in the linking.
-mlist.ftp_remote_dir = 'remote_folder'
-
-See README.md for more documentation. 
-"""
-
-
-from __future__ import nested_scopes
-
-import os
-import re
-import time
-import errno
-import binascii
-import tempfile
-import ftplib
-
-from cStringIO import StringIO
-from types import IntType, StringType
-
-from email.Utils import parsedate
-from email.Parser import HeaderParser
-from email.Generator import Generator
-from email.Charset import Charset, QP, BASE64
-from email.MIMEMultipart import MIMEMultipart
-from email.mime.image import MIMEImage
-from email import encoders
-
-
-from Mailman import mm_cfg
-from Mailman import Utils
-from Mailman import LockFile
-from Mailman import Message
-from Mailman.Errors import DiscardMessage
-from Mailman.i18n import _
-from Mailman.Logging.Syslog import syslog
-from Mailman.Utils import sha_new
-
-
-# Path characters for common platforms
-pre = re.compile(r'[/\\:]')
-# All other characters to strip out of Content-Disposition: filenames
-# (essentially anything that isn't an alphanum, dot, dash, or underscore).
-sre = re.compile(r'[^-\w.]')
-# Regexp to strip out leading dots
-dre = re.compile(r'^\.*')
-
-# match multipart content-type
-mutipartre = re.compile(r'^multipart/')
-
-BR = '<br>\n'
-SPACE = ' '
-
-# the html used to insert moved attachment
-HTML_ATTACHMENT_HOLDER = """
-   <br>
-   <div style="padding: 15px; background-color: rgb(217, 237, 255);">
-      <div style="margin-bottom: 15px;">Pi&egrave;ce jointe disponible ici
-      :</div>
-          <div style="background-color: rgb(255, 255, 255); padding: 15px;">
-          %(HTML_HERE)s
-          </div>
-   </div>
-"""
-
-# template used inside HTML_ATTACHMENT_HOLDER, for each attachment
-HTML_ATTACHMENT_CLIP_TPL = """
-<div style="border: 1px solid rgb(205, 205, 205); border-radius:
-  5px 5px 5px 5px; margin-top: 10px; margin-bottom: 10px;
-  padding: 15px;" class="cloudAttachmentItem"><img
-    src="cid:%(CID_clip)s"
-    style="margin-right: 5px; float: left; width: 24px; height:
-    24px;"><a style="color: rgb(15, 126, 219) ! important;" 
-    href="%(URL_replace)s">%(FNAME_replace)s</a><span
-    style="margin-left: 5px; font-size: small; color: grey;">
-    (%(SIZE_replace)s)</span>
-</div>
-"""
-
-# plain text template
-TXT_ATTACHT_REPLACE = """
---------------------
-Mailman attachment :
---------------------
-Pièce(s) jointe(s) disponible ici :
-"""
-
-# Content-Type: image/png; name="attachment-24.png"
-# Content-Transfer-Encoding: base64
-# Content-ID: <part1.%(CID_clip)s>
-# Content-Disposition: inline; filename="attachment-24.png"
-
-# embeded clip picture base64
-ATTACH_CLIP = """
-iVBORw0KGgoAAAANSUhEUgAAABgAAAAYCAYAAADgdz34AAAABHNCSVQICAgIfAhkiAAAAAlw
-SFlzAAAN1wAADdcBQiibeAAAABl0RVh0U29mdHdhcmUAd3d3Lmlua3NjYXBlLm9yZ5vuPBoA
-AAH+SURBVEiJ7ZVNaxNRFIaf09T6AXXpUgQpfmGnSmYSsCB0qe50pdJFuxEVKhUEQVBcCipI
-S+yiG21dxLoTEQQFV83MBJJpF0LxRyiK0EzmddEkGMlnxV0PDMzc97znuefeuTMmif8Zg+2E
-dDq9KyY1LZjFGGkSxYbBk0Gqi2EYVrYFiElNy8i1FI0RQS4mJWChE2CgnSCY3brRTBT6qXJQ
-sHJQsCj0U5jdquXMdCreEVBflqgYzElKGmApOXLo4Fzt8RiA43orjpdZ7g/wR8FRN/PWcbNv
-6mP5fL7612wuIi638rfdgyY7nIftvW1dO/jX2AHsABohgKPj48MAjnPmQG08aevoE/AZYGgz
-vgTAUHwdAONdN2OPB81eCJ016bbjZr9T/05VedrN26mDbwCnPG8s/rU3j9gAToBWgGGMV+Vi
-4WN92foHyJYBEtmd9fVPPyzFBUEAIOlhFPhXAXZvVp7XDGutyli7P9rpbPZ4taoisMfgWiko
-LACcTKcPr4XhV4AxNzsltAj8lKrpKAy/9AwAGPW8KyZbAipmmir5/lJDc7PnDL0G9hk2WQpW
-X/bVQT0cN/MAuL+VbY+TJM4ZA5Nmdg8YMDRfCvyb7fxdAbXZ3jD0jOY9SwR3o6DwqJO3p3MQ
-BavzMk0A74HE0AeZJroVB0BSX1cmk9nfT/5vekgJrtOb2V0AAAAASUVORK5CYII=
-"""
-
-try:
-    True, False
-except NameError:
-    True = 1
-    False = 0
-
-
-try:
-    from mimetypes import guess_all_extensions
-except ImportError:
-    import mimetypes
-    def guess_all_extensions(ctype, strict=True):
-        # BAW: sigh, guess_all_extensions() is new in Python 2.3
-        all = []
-        def check(map):
-            for e, t in map.items():
-                if t == ctype:
-                    all.append(e)
-        check(mimetypes.types_map)
-        # Python 2.1 doesn't have common_types.  Sigh, sigh.
-        if not strict and hasattr(mimetypes, 'common_types'):
-            check(mimetypes.common_types)
-        return all
-
-# internal global to handle debugging, use mlist.debug = 1 to enable it
-DEBUG = False
-
-def process(mlist, msg, msgdata=None):
-    # main entry code for the Handler
-    global DEBUG
-    if hasattr(mlist, 'debug'):
-        DEBUG = mlist.debug
-
-    debug('AttachmentMove Enter ' + '-' * 30)
-
-    if msgdata is None:
-        msgdata = {}
-    
-    modified = False
-    
-    #dir = calculate_attachments_dir(mlist, msg, msgdata)
-    dir = 'attachments-moved'
-    # Now walk over all subparts of this message and scrub out various types
-    seen_attachment = []
-    boundary = None
-
-    # as we replace some content we will have to fight with encoding
-    # set some default list encoding
-    lcset = Utils.GetCharSet(mlist.preferred_language)
-    lcset_out = Charset(lcset).output_charset or lcset
-
-    
-    for part in msg.walk():
-        ctype = part.get_content_type()
-        partlen = len(part.get_payload())
-        debug('met part : %s %d', ctype, partlen)
-
-        # If the part is text/plain, we leave it alone
-        if ctype == 'text/plain':
-            continue
-        elif ctype == 'text/html':
-            continue
-        elif ctype == 'message/rfc822':
-            continue
-        elif partlen > 0 and not part.is_multipart():
-            # we met an attachment
-            debug('> part is attachment %s', ctype)
-            if part.has_key('Content-ID'):
-                debug('> part as Content-ID %s', part['Content-ID'])
-                # keep it
-                continue
-            else:
-                debug('> detaching...')
-
-            # we are going to detach it and store it localy and remotly
-            # a dic storing attachment related data
-            attachment = {}
-            fname = get_attachment_fname(mlist, part)
-            debug('get_attachment_fname:%s, type:%s', fname, type(fname))
-            attachment['name'] = fname
-            attachment['orig'] = fname
-            attachment['size'] = sizeof_fmt(partlen)
-            debug('> att: %s', fname)
-            # save attachment to the disk, at this stage duplicate name
-            # are resolved
-            path, url = save_attachment(mlist, part, dir)
-            debug('> detached: %s %s', path, url)
-            # remote storing, no trouble very simple code here using
-            # secured FTP and the remote user config
-            if 'disable_upload' in msgdata:
-                debug('> uploading disabled')
-                remote_fname = 'disabled'
-            else:
-                remote_fname = ftp_upload_attchment(mlist, path)
-            # build the new url of the document, will be used when 
-            # modifying parts, see bellow.
-            url = mlist.remote_http_base + remote_fname
-            attachment['url'] = url
-            reset_payload(part, 'removed', fname, url)
-            seen_attachment.append(attachment)
-            modified = True
-            continue
-        elif mutipartre.search(ctype):
-            # match multipart/*
-            boundary = part.get_boundary()
-            debug('>>> is multipart part %s, boundary: %s',
-                ctype, boundary)
-            continue
-        else:
-            if boundary != None and part.get_boundary() == boundary:
-                debug('same boundary skiped : %s', ctype)
-                continue
-            else:
-                boundary = None
-            debug('attachement : %s', ctype)
-
-        debug('end of loop?? : %s', ctype)
-
-    if not modified:
-        return msg
-
-    # rewrite content
-    # d is a dict for simple storage of mutliple parameters
-    # will be passed to the recursive func fix_msg()
-    d = {}
-    d['footer_attach'] = ''
-    d['html_footer_attach'] = ''
-
-    clip_cid = "clip.12345789"
-    # the clip is already base64 encoded above
-    d['clip'] = MIMEImage(ATTACH_CLIP, 'png', _encoder=encoders.encode_noop)
-    d['clip']['Content-Transfer-Encoding'] = 'base64'
-    d['clip'].add_header('Content-ID', '<part1.%s>' % clip_cid)
-
-    replace = {}
-    replace['CID_clip'] = 'part1.' + clip_cid
-    # compose attachment url
-    for att in seen_attachment:
-        d['footer_attach'] += make_link(att) + "\n"
-        replace['FNAME_replace'] = att['orig']
-        replace['URL_replace'] = att['url']
-        replace['SIZE_replace'] = att['size']
-        d['html_footer_attach'] += HTML_ATTACHMENT_CLIP_TPL % replace
-   
-    debug('================ start fix_msg() ==================')
-    d['lcset'] = lcset
-    d['lcset_out'] = lcset_out
-
-    d['do_txt'] = True
-    d['do_html'] = True
-
-    fix_msg(msg, d)
-
-    return msg
-
-def reset_payload(msg, txt, fname, url):
-    # Reset payload of msg to contents of subpart, and fix up content headers
-    msg.set_payload(txt)
-    del msg['content-type']
-    del msg['content-transfer-encoding']
-    del msg['content-disposition']
-    del msg['content-description']
-    
-    msg.add_header('X-Mailman-Part', 'Attachment-moved', url=url)
-    msg.add_header('Content-Type', 'text/plain', charset='UTF-8', name=fname)
-    msg.add_header('Content-Transfer-Encoding', '8bit')
-    msg.add_header('Content-Disposition', 'attachment', filename=fname)
-    msg.add_header('Content-Description', "Attachment-moved by Mailman")
-
-
-def fix_msg(msg, data):
-    """
-    Scan the message recursively to replace the text/html by a 
-    multipart/related containing the original text/html and the new 
-    clip_payload png attachment. The attachment detected and moved at
-    the first pass (with Header X-Mailman-Part) will be removed.
-    """
-
-    if msg.is_multipart():
-        parts = msg.get_payload()
-        # remove the next level parts, then process and reattach them
-        msg.set_payload(None)
-        for p in parts:
-            # recursive call
-            r = fix_msg(p, data)
-            # don't embbed related twice
-            if msg.get_content_type() == 'multipart/related' and \
-                 r.get_content_type() == 'multipart/related':
-                for newp in r.get_payload():
-                    msg.attach(newp)
-            elif r == None:
-                # removed
-                continue
-            else:
-                msg.attach(r)
-        # finished
-        return msg
-    else:
-        # process the 'leaf' parts
-        ctype = msg.get_content_type()
-        # will be used to write back payload with correct encoding
-        charset = msg.get_content_charset()
-        c = Charset('utf-8')
-        c.body_encoding = QP
-        debug('ctype:%s charset:%s', ctype, charset)
-        if ctype == 'text/plain':
-            if msg['X-Mailman-Part']:
-                # remove it!
-                return None
-
-            if data['do_txt']:
-                # A normal txt part, add footer to plain text
-                new_footer = TXT_ATTACHT_REPLACE
-                new_footer += data['footer_attach']
-                old_content = msg.get_payload(decode=True)
-                debug('old_content:%s, new_footer:%s', \
-                    type(old_content), type(new_footer))
-
-                del msg['Content-type']
-                del msg['content-transfer-encoding']
-                msg.set_payload(old_content + new_footer, charset=c)
-
-                debug('add txt footer')
-                data['do_txt'] = False
-
-            return msg
-        elif ctype == 'text/html' and data['do_html']:
-            # build multipart/related for HTML, will be canceled by the
-            # parent recursive call if needed
-            related = MIMEMultipart('related')
-
-            html_footer = HTML_ATTACHMENT_HOLDER % \
-                {'HTML_HERE': data['html_footer_attach'] }
-            html_footer += '</body>'
-            old_content = msg.get_payload(decode=True)
-            new_content = re.sub(r'</body>', html_footer, old_content)
-
-            if old_content != new_content:
-                debug('add html footer')
-            else:
-                debug('no html footer added')
-
-            del msg['content-transfer-encoding']
-            msg.set_payload(new_content, charset=c)
-
-            related.attach(msg)
-            related.attach(data['clip'])
-            data['do_html'] = False
-            return related
-        # unmodified
-        return msg
-
-def make_link(att):
-    return att['orig'] + ' <' + att['url']  + '> (' + att['size'] + ')' 
-
-def sizeof_fmt(num):
-    #for x in ['bytes','KB','MB','GB','TB']:
-    for x in ['octets','Ko','Mo','Go','To']:
-        if num < 1024.0:
-            return "%3.1f %s" % (num, x)
-        num /= 1024.0
-
-def guess_extension(ctype, ext):
-    # mimetypes maps multiple extensions to the same type, e.g. .doc, .dot,
-    # and .wiz are all mapped to application/msword.  This sucks for finding
-    # the best reverse mapping.  If the extension is one of the giving
-    # mappings, we'll trust that, otherwise we'll just guess. :/
-    all = guess_all_extensions(ctype, strict=False)
-    if ext in all:
-        return ext
-    return all and all[0]
-
-
-def safe_strftime(fmt, t):
-    try:
-        return time.strftime(fmt, t)
-    except (TypeError, ValueError, OverflowError):
-        return None
-
-
-def calculate_attachments_dir(mlist, msg, msgdata):
-    # Calculate the directory that attachments for this message will go
-    # under.  To avoid inode limitations, the scheme will be:
-    # archives/private/<listname>/attachments/YYYYMMDD/<msgid-hash>/<files>
-    # Start by calculating the date-based and msgid-hash components.
-    fmt = '%Y%m%d'
-    datestr = msg.get('Date')
-    if datestr:
-        now = parsedate(datestr)
-    else:
-        now = time.gmtime(msgdata.get('received_time', time.time()))
-    datedir = safe_strftime(fmt, now)
-    if not datedir:
-        datestr = msgdata.get('X-List-Received-Date')
-        if datestr:
-            datedir = safe_strftime(fmt, datestr)
-    if not datedir:
-        # What next?  Unixfrom, I guess.
-        parts = msg.get_unixfrom().split()
-        try:
-            month = {'Jan':1, 'Feb':2, 'Mar':3, 'Apr':4, 'May':5, 'Jun':6,
-                     'Jul':7, 'Aug':8, 'Sep':9, 'Oct':10, 'Nov':11, 'Dec':12,
-                     }.get(parts[3], 0)
-            day = int(parts[4])
-            year = int(parts[6])
-        except (IndexError, ValueError):
-            # Best we can do I think
-            month = day = year = 0
-        datedir = '%04d%02d%02d' % (year, month, day)
-    assert datedir
-    # As for the msgid hash, we'll base this part on the Message-ID: so that
-    # all attachments for the same message end up in the same directory (we'll
-    # uniquify the filenames in that directory as needed).  We use the first 2
-    # and last 2 bytes of the SHA1 hash of the message id as the basis of the
-    # directory name.  Clashes here don't really matter too much, and that
-    # still gives us a 32-bit space to work with.
-    msgid = msg['message-id']
-    if msgid is None:
-        msgid = msg['Message-ID'] = Utils.unique_message_id(mlist)
-    # We assume that the message id actually /is/ unique!
-    digest = sha_new(msgid).hexdigest()
-    # hash disabled to handle file duplicate over mutiple email.
-    #return os.path.join('attachments', datedir, digest[:4] + digest[-4:])
-    return os.path.join('attachments', datedir)
-
-
-def makedirs(dir):
-    # Create all the directories to store this attachment in
-    try:
-        os.makedirs(dir, 02775)
-        # Unfortunately, FreeBSD seems to be broken in that it doesn't honor
-        # the mode arg of mkdir().
-        def twiddle(arg, dirname, names):
-            os.chmod(dirname, 02775)
-        os.path.walk(dir, twiddle, None)
-    except OSError, e:
-        if e.errno <> errno.EEXIST: raise
-
-import unicodedata
-
-def remove_accents(input_str):
-    try:
-        nkfd_form = unicodedata.normalize('NFKD', input_str)
-    except TypeError:
-        nkfd_form = unicodedata.normalize('NFKD', unicode(input_str))
-
-    return u"".join([c for c in nkfd_form if not unicodedata.combining(c)])
-
-def get_attachment_fname(mlist, msg):
-    # i18n file name is encoded
-    lcset = Utils.GetCharSet(mlist.preferred_language)
-    filename = Utils.oneline(msg.get_filename(''), lcset)
-    # filename can be 'str' or unicode
-    return remove_accents(filename).encode('ascii')
-
-
-def save_attachment(mlist, msg, dir):
-    # attachment is extracted from the message part pointed by msg and stored
-    # to standard mailman attachement dir. See Mailman/Handlers/Scrubber.py 
-    # where this code come from. Scrubber specific behavior have been removed
-    # the return value is a composed pair, physical filename and it's mailman's
-    # list url. Not used by this handler, see ftp_upload_attchment().
-    fsdir = os.path.join(mlist.archive_dir(), dir)
-    makedirs(fsdir)
-    # Figure out the attachment type and get the decoded data
-    decodedpayload = msg.get_payload(decode=True)
-    # BAW: mimetypes ought to handle non-standard, but commonly found types,
-    # e.g. image/jpg (should be image/jpeg).  For now we just store such
-    # things as application/octet-streams since that seems the safest.
-    ctype = msg.get_content_type()
-    filename = get_attachment_fname(mlist, msg)
-    filename, fnext = os.path.splitext(filename)
-    # HTML message doesn't have filename :-(
-    ext = fnext or guess_extension(ctype, fnext)
-    if not ext:
-        # We don't know what it is, so assume it's just a shapeless
-        # application/octet-stream, unless the Content-Type: is
-        # message/rfc822, in which case we know we'll coerce the type to
-        # text/plain below.
-        if ctype == 'message/rfc822':
-            ext = '.txt'
-        else:
-            ext = '.bin'
-    # Allow only alphanumerics, dash, underscore, and dot
-    ext = sre.sub('', ext)
-    path = None
-    # We need a lock to calculate the next attachment number
-    lockfile = os.path.join(fsdir, 'attachments.lock')
-    lock = LockFile.LockFile(lockfile)
-    lock.lock()
-    try:
-        # Now base the filename on what's in the attachment, uniquifying it if
-        # necessary.
-        if not filename:
-            filebase = 'attachment'
-        else:
-            # Sanitize the filename given in the message headers
-            parts = pre.split(filename)
-            filename = parts[-1]
-            # Strip off leading dots
-            filename = dre.sub('', filename)
-            # Allow only alphanumerics, dash, underscore, and dot
-            filename = sre.sub('', filename)
-            # If the filename's extension doesn't match the type we guessed,
-            # which one should we go with?  For now, let's go with the one we
-            # guessed so attachments can't lie about their type.  Also, if the
-            # filename /has/ no extension, then tack on the one we guessed.
-            # The extension was removed from the name above.
-            filebase = filename
-        # Now we're looking for a unique name for this file on the file
-        # system.  If msgdir/filebase.ext isn't unique, we'll add a counter
-        # after filebase, e.g. msgdir/filebase-cnt.ext
-        counter = 0
-        extra = ''
-        while True:
-            path = os.path.join(fsdir, filebase + extra + ext)
-            # Generally it is not a good idea to test for file existance
-            # before just trying to create it, but the alternatives aren't
-            # wonderful (i.e. os.open(..., O_CREAT | O_EXCL) isn't
-            # NFS-safe).  Besides, we have an exclusive lock now, so we're
-            # guaranteed that no other process will be racing with us.
-            if os.path.exists(path):
-                counter += 1
-                extra = '-%04d' % counter
-            else:
-                break
-    finally:
-        lock.unlock()
-    # `path' now contains the unique filename for the attachment. 
-    fp = open(path, 'w')
-    fp.write(decodedpayload)
-    fp.close()
-    # Now calculate the url
-    baseurl = mlist.GetBaseArchiveURL()
-    # Private archives will likely have a trailing slash.  Normalize.
-    if baseurl[-1] <> '/':
-        baseurl += '/'
-    # A trailing space in url string may save users who are using
-    # RFC-1738 compliant MUA (Not Mozilla).
-    # Trailing space will definitely be a problem with format=flowed.
-    # Bracket the URL instead.
-    url = baseurl + '%s/%s%s%s' % (dir, filebase, extra, ext)
-    return path, url
-
-def ftp_upload_attchment(mlist, full_fname):
-    debug('uploading to %s', mlist.ftp_remote_host)
-    fname = os.path.basename(full_fname)
-    if hasattr(mlist, 'ftp_upload_prefix'):
-        fname = mlist.ftp_upload_prefix + fname
-
-    # try secure ftp first
-    retry_login = 0
-    ftp = ftplib.FTP_TLS(mlist.ftp_remote_host)
-
-    try:
-        ftp.login(mlist.ftp_remote_login, mlist.ftp_remote_pass)
-        ftp.prot_p()
-    except ftplib.error_perm:
-        retry_login = 1
-        ftp.quit()
-        # fall back to normal FTP
-        ftp = ftplib.FTP(mlist.ftp_remote_host)
-
-    if retry_login:
-        ftp.login(mlist.ftp_remote_login, mlist.ftp_remote_pass)
-    
-    if hasattr(mlist, 'ftp_remote_dir'):
-        # missing folder or wrong path will raise exception
-        ftp.cwd(mlist.ftp_remote_dir)
-
-    ftp.storbinary('STOR ' + fname, open(full_fname, 'rb'))
-    ftp.quit()
-    debug('uploading OK')
-
-    return fname
-
-def debug(msg, *args, **kws):
-    if DEBUG == 1:
-        syslog.write_ex('debug', msg, args, kws)
-
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: et sw=4 ts=4 sts=4:
+#
+# This script is opensource and can be found here:
+# https://github.com/Sylvain303/mailman-AttachmentMove
+#
+# Copyright (C) 2001-2011 by the Free Software Foundation, Inc.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301,
+# USA.
+
+""" Mail attachment detach filter
+
+The detached parts are stored as attachment on the list archive. But the 
+attachment used is a fresh copy, uploaded to a remote location given by the
+extra required parameters:
+
+mlist.ftp_remote_host = 'ftp.example.com'
+mlist.ftp_remote_login = 'username'
+mlist.ftp_remote_pass = 'secr3te'
+# put the ending slash /
+mlist.remote_http_base = 'http://example.com/root/for/username/'
+
+# optional, a prefix on the remote storage:
+mlist.ftp_upload_prefix = 'listname_or_dev_'
+# optional, a folder on the remote storage. Not used in the linking.
+mlist.ftp_remote_dir = 'remote_folder'
+
+See README.md for more documentation. 
+"""
+
+
+from __future__ import nested_scopes
+
+import os
+import re
+import time
+import errno
+import binascii
+import tempfile
+import ftplib
+import quopri
+import cgi
+import fnmatch
+import hashlib
+import cPickle
+import threading
+import Queue
+import httplib
+import urlparse
+import urllib
+import socket
+import shutil
+import hmac
+import mimetypes
+import mmap
+import fcntl
+import copy
+import sqlite3
+import sys
+import multiprocessing
+
+from cStringIO import StringIO
+from types import IntType, StringType
+
+from email.Utils import parsedate, parseaddr, parsedate_tz, mktime_tz
+from email.Parser import HeaderParser
+from email.Generator import Generator
+from email.Charset import Charset, QP, BASE64
+from email.MIMEMultipart import MIMEMultipart
+from email.mime.image import MIMEImage
+from email import encoders
+import email
+
+
+from Mailman import mm_cfg
+from Mailman import Utils
+from Mailman import LockFile
+from Mailman import Message
+from Mailman.Errors import DiscardMessage
+from Mailman.Handlers import ToArchive
+from Mailman.i18n import _
+from Mailman.Logging.Syslog import syslog
+from Mailman.Utils import sha_new
+
+# optional, for the image derivatives, see make_derivatives()
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
+# optional, the ASCII spelling of the file names in any script, see
+# remove_accents()
+try:
+    from unidecode import unidecode
+except ImportError:
+    unidecode = None
+
+
+# Path characters for common platforms
+pre = re.compile(r'[/\\:]')
+# All other characters to strip out of Content-Disposition: filenames
+# (essentially anything that isn't an alphanum, dot, dash, or underscore).
+sre = re.compile(r'[^-\w.]')
+# Regexp to strip out leading dots
+dre = re.compile(r'^\.*')
+
+# match multipart content-type
+mutipartre = re.compile(r'^multipart/')
+
+BR = '<br>\n'
+SPACE = ' '
+
+# the html used to insert moved attachment
+HTML_ATTACHMENT_HOLDER = """
+   <br>
+   <div style="padding: 15px; background-color: rgb(217, 237, 255);">
+      <div style="margin-bottom: 15px;">%(TITLE)s</div>
+          <div style="background-color: rgb(255, 255, 255); padding: 15px;">
+          %(HTML_HERE)s
+          </div>
+   </div>
+"""
+
+# template used inside HTML_ATTACHMENT_HOLDER, for each attachment
+HTML_ATTACHMENT_CLIP_TPL = """
+<div style="border: 1px solid rgb(205, 205, 205); border-radius:
+  5px 5px 5px 5px; margin-top: 10px; margin-bottom: 10px;
+  padding: 15px;" class="cloudAttachmentItem"><img
+    src="cid:%(CID_clip)s"
+    style="margin-right: 5px; float: left; width: 24px; height:
+    24px;"><a style="color: rgb(15, 126, 219) ! important;" 
+    href="%(URL_replace)s">%(FNAME_replace)s</a><span
+    style="margin-left: 5px; font-size: small; color: grey;">
+    (%(SIZE_replace)s)</span>
+</div>
+"""
+
+# the same for an image with a thumbnail, linking to its web version
+HTML_ATTACHMENT_THUMB_TPL = """
+<div style="border: 1px solid rgb(205, 205, 205); border-radius:
+  5px 5px 5px 5px; margin-top: 10px; margin-bottom: 10px;
+  padding: 15px;" class="cloudAttachmentItem"><a
+    href="%(WEB_replace)s"><img src="%(THUMB_replace)s"
+    alt="%(FNAME_replace)s" style="display: block; border: 0;
+    margin-bottom: 5px;"></a><a style="color: rgb(15, 126, 219) ! important;"
+    href="%(URL_replace)s">%(FNAME_replace)s</a><span
+    style="margin-left: 5px; font-size: small; color: grey;">
+    (%(SIZE_replace)s)</span>
+</div>
+"""
+
+# plain text template
+TXT_ATTACHT_REPLACE = """
+--------------------
+Mailman attachment :
+--------------------
+%(TITLE)s
+"""
+
+# the footer titles and size units by list language, the ones of
+# FOOTER_DEFAULT_LANGUAGE for the others. A list can also set its own
+# titles, see FooterRenderer.
+FOOTER_LANGUAGES = {
+    'fr': {'text_title': 'Pièce(s) jointe(s) disponible ici :',
+           'html_title': 'Pi&egrave;ce jointe disponible ici\n      :',
+           'units': ['octets', 'Ko', 'Mo', 'Go', 'To'],
+           },
+    'en': {'text_title': 'Attachment(s) available here:',
+           'html_title': 'Attachment(s) available here:',
+           'units': ['bytes', 'KB', 'MB', 'GB', 'TB'],
+           },
+    }
+FOOTER_DEFAULT_LANGUAGE = 'fr'
+
+# Content-Type: image/png; name="attachment-24.png"
+# Content-Transfer-Encoding: base64
+# Content-ID: <part1.%(CID_clip)s>
+# Content-Disposition: inline; filename="attachment-24.png"
+
+# embeded clip picture base64
+ATTACH_CLIP = """
+iVBORw0KGgoAAAANSUhEUgAAABgAAAAYCAYAAADgdz34AAAABHNCSVQICAgIfAhkiAAAAAlw
+SFlzAAAN1wAADdcBQiibeAAAABl0RVh0U29mdHdhcmUAd3d3Lmlua3NjYXBlLm9yZ5vuPBoA
+AAH+SURBVEiJ7ZVNaxNRFIaf09T6AXXpUgQpfmGnSmYSsCB0qe50pdJFuxEVKhUEQVBcCipI
+S+yiG21dxLoTEQQFV83MBJJpF0LxRyiK0EzmddEkGMlnxV0PDMzc97znuefeuTMmif8Zg+2E
+dDq9KyY1LZjFGGkSxYbBk0Gqi2EYVrYFiElNy8i1FI0RQS4mJWChE2CgnSCY3brRTBT6qXJQ
+sHJQsCj0U5jdquXMdCreEVBflqgYzElKGmApOXLo4Fzt8RiA43orjpdZ7g/wR8FRN/PWcbNv
+6mP5fL7612wuIi638rfdgyY7nIftvW1dO/jX2AHsABohgKPj48MAjnPmQG08aevoE/AZYGgz
+vgTAUHwdAONdN2OPB81eCJ016bbjZr9T/05VedrN26mDbwCnPG8s/rU3j9gAToBWgGGMV+Vi
+4WN92foHyJYBEtmd9fVPPyzFBUEAIOlhFPhXAXZvVp7XDGutyli7P9rpbPZ4taoisMfgWiko
+LACcTKcPr4XhV4AxNzsltAj8lKrpKAy/9AwAGPW8KyZbAipmmir5/lJDc7PnDL0G9hk2WQpW
+X/bVQT0cN/MAuL+VbY+TJM4ZA5Nmdg8YMDRfCvyb7fxdAbXZ3jD0jOY9SwR3o6DwqJO3p3MQ
+BavzMk0A74HE0AeZJroVB0BSX1cmk9nfT/5vekgJrtOb2V0AAAAASUVORK5CYII=
+"""
+
+try:
+    True, False
+except NameError:
+    True = 1
+    False = 0
+
+
+try:
+    from mimetypes import guess_all_extensions
+except ImportError:
+    import mimetypes
+    def guess_all_extensions(ctype, strict=True):
+        # BAW: sigh, guess_all_extensions() is new in Python 2.3
+        all = []
+        def check(map):
+            for e, t in map.items():
+                if t == ctype:
+                    all.append(e)
+        check(mimetypes.types_map)
+        # Python 2.1 doesn't have common_types.  Sigh, sigh.
+        if not strict and hasattr(mimetypes, 'common_types'):
+            check(mimetypes.common_types)
+        return all
+
+# internal global to handle debugging, use mlist.debug = 1 to enable it
+DEBUG = False
+
+# where the detached parts are stored in the list archive folder, see
+# calculate_attachments_dir()
+ATTACHMENTS_DIR = 'attachments-moved'
+# joins the sub folders of a sharded layout to the remote name, see
+# get_remote_fname(). It used to be '-', the files uploaded then keep their
+# names
+SHARD_SEP = '~'
+
+# metrics export, set in mm_cfg.py, see Metrics:
+# a Prometheus text file, for the node_exporter textfile collector, %(pid)d
+# is replaced by the runner process id
+#ATTACHMENTMOVE_METRICS_FILE = '/var/lib/prometheus/node-exporter/attachmentmove-%(pid)d.prom'
+# and/or a StatsD server 'host:port'
+#ATTACHMENTMOVE_STATSD = '127.0.0.1:8125'
+# seconds between two writes of the metrics file
+METRICS_FILE_INTERVAL = 60
+
+# DetachPolicy of each list, with the settings it was compiled from
+policies = {}
+# FooterRenderer of each list, the same way
+renderers = {}
+# guess_extension() results by (content type, extension), emptied when it
+# holds more than GUESSED_EXTENSIONS_MAX, the types come from the messages
+guessed_extensions = {}
+GUESSED_EXTENSIONS_MAX = 1000
+
+# msgdata['moved_attachments'] is a list of dict with those keys, one per
+# stored file: the file name given by the sender (~thumb or ~web added for
+# the image derivatives), the local copy (None when an already hosted copy
+# is used), the url, the remote name, the size and the SHA-256 of the
+# content (None for the derivatives)
+MOVED_FIELDS = ('filename', 'path', 'url', 'remote', 'size', 'hash')
+
+# bytes of encoded payload decoded at once, see decode_payload()
+DECODE_BLOCK_SIZE = 1024 * 1024
+
+# default seconds an unused FTP session is kept open, see FTPPool
+FTP_POOL_IDLE_TIMEOUT = 60
+# seconds an unused HTTP connection is kept open, see HTTPPool
+HTTP_POOL_IDLE_TIMEOUT = 30
+
+# default seconds to wait for the remote storage: to connect, and for any
+# answer once connected (mlist.remote_connect_timeout and
+# mlist.remote_transfer_timeout)
+REMOTE_CONNECT_TIMEOUT = 10
+REMOTE_TRANSFER_TIMEOUT = 60
+
+# the remote storage is considered down after this many failed uploads in a
+# row, by all the runner processes, then probed every BREAKER_COOLDOWN
+# seconds, see CircuitBreaker
+BREAKER_FAILURES = 3
+BREAKER_COOLDOWN = 60
+
+# attempts to upload a file before giving up, FTP uploads resume where the
+# previous attempt stopped
+UPLOAD_TRIES = 3
+
+# bytes handed at once to the socket when uploading, see MappedFile
+UPLOAD_BLOCK_SIZE = 256 * 1024
+
+# S3 files bigger than this are uploaded in parts of S3_MULTIPART_SIZE,
+# 5 MB at least
+S3_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+S3_MULTIPART_SIZE = 8 * 1024 * 1024
+
+# host-wide upload limits, see UploadLimiter: files smaller than this may
+# take the last upload session of a host, and a waiting upload looks for a
+# free session every UPLOAD_SESSION_WAIT seconds
+UPLOAD_SMALL_SIZE = 1024 * 1024
+UPLOAD_SESSION_WAIT = 0.1
+
+# asynchronous uploads, see drain_upload_spool()
+UPLOAD_MAX_TRIES = 10
+# seconds before the first retry, doubled for each failure
+UPLOAD_RETRY_DELAY = 30
+UPLOAD_RETRY_MAX_DELAY = 3600
+# seconds between two spool scans in loop mode
+UPLOAD_SPOOL_SLEEP = 5
+
+# the index of the detached parts, shared by all the lists, set
+# ATTACHMENTMOVE_INDEX = None in mm_cfg.py to disable it, see index_record()
+INDEX_FILE = os.path.join(mm_cfg.DATA_DIR, 'attachmentmove-index.db')
+# attempts at creating the index schema, see get_index()
+INDEX_SETUP_TRIES = 5
+
+# remote files deleted per second at most by gc_attachments(), to leave
+# the storage to the live traffic
+GC_DELETE_RATE = 10
+
+# image derivatives, see make_derivatives(): default longest side in pixels
+# of the web version and of the thumbnail, and JPEG quality
+IMAGE_WEB_SIZE = 1600
+IMAGE_THUMB_SIZE = 200
+IMAGE_QUALITY = 80
+# threads making them, shared by the lists
+IMAGE_WORKERS = 2
+
+# messages handed to the workers at once by retro_process(), the progress
+# is saved after each batch
+RETRO_BATCH_SIZE = 200
+
+def process(mlist, msg, msgdata=None):
+    # main entry code for the Handler
+    global DEBUG, debug
+    if hasattr(mlist, 'debug'):
+        DEBUG = mlist.debug
+    if DEBUG == 1:
+        debug = debug_on
+    else:
+        debug = debug_off
+
+    debug('AttachmentMove Enter %s', '-' * 30)
+
+    if msgdata is None:
+        msgdata = {}
+
+    start = time.time()
+    try:
+        return move_attachments(mlist, msg, msgdata)
+    finally:
+        metrics.timing('process', time.time() - start)
+        metrics.flush()
+
+def move_attachments(mlist, msg, msgdata):
+    metrics.incr('messages')
+    # most messages have nothing to detach, don't prepare anything for them
+    start = time.time()
+    to_detach = get_policy(mlist).select(msg)
+    metrics.timing('scan', time.time() - start)
+    if not to_detach:
+        debug('nothing to detach')
+        metrics.incr('fast_path')
+        return msg
+
+    # the remote storage is down? see CircuitBreaker
+    degraded = None
+    if 'disable_upload' not in msgdata and CircuitBreaker(mlist).is_open():
+        degraded = getattr(mlist, 'remote_degraded_mode', 'queue')
+        metrics.incr('degraded')
+        debug('remote storage down, %s mode', degraded)
+        if degraded == 'inline':
+            return msg
+
+    modified = False
+    
+    dir = calculate_attachments_dir(mlist, msg, msgdata)
+    # Now walk over all subparts of this message and scrub out various types
+    seen_attachment = []
+    # (path, remote_fname, digest) waiting for upload, digest is recorded
+    # for the deduplication once uploaded, None if not
+    uploads = []
+    # retro_process() forces it for its messages only
+    dedup = msgdata.get('attachment_dedup',
+                        getattr(mlist, 'attachment_dedup', 0))
+    dedup_hits = dedup_misses = 0
+    # rows for index_record()
+    index_rows = []
+    # (attachment, fname, DerivativeJob) of the images
+    derivatives = []
+    image_settings = get_image_settings(mlist, msgdata)
+    if degraded == 'local':
+        image_settings = None
+    boundary = None
+
+    renderer = get_renderer(mlist)
+
+    
+    # the parts rewritten once all the attachments are known, with their
+    # parent, found during the same walk: the first text/plain and
+    # text/html, and the detached ones.
+    text_part = html_part = None
+    detached = []
+
+    for parent, part in walk_parts(msg):
+        ctype = part.get_content_type()
+        partlen = len(part.get_payload())
+        debug('met part : %s %d', ctype, partlen)
+
+        # If the part is text/plain, we leave it alone
+        if ctype == 'text/plain':
+            if text_part is None:
+                text_part = (parent, part)
+            continue
+        elif ctype == 'text/html':
+            if html_part is None:
+                html_part = (parent, part)
+            continue
+        elif ctype == 'message/rfc822':
+            continue
+        elif id(part) in to_detach:
+            # we met an attachment
+            debug('> part is attachment %s, detaching...', ctype)
+
+            # we are going to detach it and store it localy and remotly
+            # a dic storing attachment related data
+            attachment = {}
+            # its headers are decoded once, here and by save_attachment()
+            info = PartInfo(part, renderer.lcset, ctype)
+            start = time.time()
+            fname = info.fname
+            metrics.timing('sanitize', time.time() - start)
+            debug('get_attachment_fname:%s, type:%s', fname, type(fname))
+            attachment['name'] = fname
+            # the real name in the footers
+            attachment['orig'] = info.title
+            debug('> att: %s', fname)
+            # decode it to a temporary file, giving its real size and hash
+            start = time.time()
+            tmpfile, info.size, digest = spool_attachment(mlist, part, dir)
+            metrics.incr('attachments')
+            metrics.incr('bytes_detached', info.size)
+            attachment['size'] = sizeof_fmt(info.size, renderer.units)
+            remote_fname = path = None
+            if dedup:
+                # same content already hosted, by any list using the same
+                # remote location?
+                remote_fname = dedup_lookup(mlist, digest)
+            if remote_fname:
+                debug('> already hosted: %s', remote_fname)
+                os.unlink(tmpfile)
+                metrics.timing('save', time.time() - start)
+                dedup_hits += 1
+            else:
+                # save attachment to the disk, at this stage duplicate name
+                # are resolved
+                path, url = save_attachment(mlist, part, dir, tmpfile, info)
+                metrics.timing('save', time.time() - start)
+                debug('> detached: %s %s', path, url)
+                # remote storing, no trouble very simple code here using
+                # secured FTP and the remote user config
+                if 'disable_upload' in msgdata:
+                    debug('> uploading disabled')
+                    remote_fname = 'disabled'
+                elif degraded == 'local':
+                    # the link goes to the archive copy, url above
+                    debug('> not uploaded')
+                elif degraded or getattr(mlist, 'ftp_upload_async', 0):
+                    # the upload is done later by drain_upload_spool(), the
+                    # remote name is known now so the link can be written
+                    remote_fname = enqueue_upload(mlist, path,
+                                                  dedup and digest or None)
+                else:
+                    # uploaded all together after the walk
+                    remote_fname = get_remote_fname(mlist, path)
+                    uploads.append((path, remote_fname,
+                                    dedup and digest or None))
+                if dedup and 'disable_upload' not in msgdata:
+                    # recorded once uploaded, see upload_attachments()
+                    dedup_misses += 1
+                if image_settings and ctype.startswith('image/'):
+                    # made while the walk goes on
+                    derivatives.append((attachment, fname,
+                                        derivative_pool.submit(path,
+                                                               image_settings)))
+            # build the new url of the document, will be used when 
+            # modifying parts, see bellow.
+            if remote_fname:
+                url = get_backend(mlist).url_for(remote_fname)
+            attachment['url'] = url
+            index_rows.append((fname, path, url, remote_fname, info.size,
+                               digest))
+            if parent is None:
+                # the message itself is the attachment, nothing to remove it
+                # from, leave a placeholder
+                reset_payload(part, 'removed', fname, url)
+            else:
+                # drop the content now, the part is removed after the walk
+                part.set_payload('')
+                detached.append((parent, part))
+            seen_attachment.append(attachment)
+            modified = True
+            continue
+        elif mutipartre.search(ctype):
+            # match multipart/*
+            boundary = part.get_boundary()
+            debug('>>> is multipart part %s, boundary: %s',
+                ctype, boundary)
+            continue
+        else:
+            if boundary != None and part.get_boundary() == boundary:
+                debug('same boundary skiped : %s', ctype)
+                continue
+            else:
+                boundary = None
+            debug('attachement : %s', ctype)
+
+        debug('end of loop?? : %s', ctype)
+
+    if dedup and (dedup_hits or dedup_misses):
+        metrics.incr('dedup_hits', dedup_hits)
+        dedup_count(mlist, dedup_hits, dedup_misses)
+
+    if not modified:
+        return msg
+
+    for attachment, fname, job in derivatives:
+        for kind, path in job.wait().items():
+            # uploaded as the original
+            if degraded or getattr(mlist, 'ftp_upload_async', 0):
+                remote_fname = enqueue_upload(mlist, path)
+            else:
+                remote_fname = get_remote_fname(mlist, path)
+                uploads.append((path, remote_fname, None))
+            url = get_backend(mlist).url_for(remote_fname)
+            attachment[kind] = url
+            index_rows.append(('%s~%s' % (fname, kind), path, url,
+                               remote_fname, os.path.getsize(path), None))
+
+    if uploads:
+        upload_attachments(mlist, uploads)
+    index_record(mlist, msg, index_rows)
+    # for the next handlers, see archive_process()
+    msgdata['moved_attachments'] = [dict(zip(MOVED_FIELDS, row))
+                                    for row in index_rows]
+
+    # rewrite content
+    # d is a dict for simple storage of mutliple parameters
+    # will be passed to add_txt_footer() and add_html_footer()
+    debug('================ start rewrite ==================')
+    start = time.time()
+    d = renderer.render(seen_attachment)
+
+    for parent, part in detached:
+        remove_part(parent, part)
+    if text_part:
+        add_txt_footer(text_part[1], d)
+    if html_part:
+        add_html_footer(html_part[0], html_part[1], d)
+    metrics.timing('rewrite', time.time() - start)
+
+    return msg
+
+def is_detachable(part):
+    # the parts moved away: non text leaves with some content, except the
+    # ones with a Content-ID, embedded in the html
+    if part.get_content_type() in ('text/plain', 'text/html',
+                                   'message/rfc822'):
+        return False
+    if part.is_multipart() or not part.get_payload():
+        return False
+    if part.has_key('Content-ID'):
+        debug('> part as Content-ID %s', part['Content-ID'])
+        return False
+    return True
+
+def estimate_size(part):
+    # decoded size of a leaf part, without decoding it
+    size = len(part.get_payload())
+    if part.get('content-transfer-encoding', '').lower() == 'base64':
+        size = size * 3 / 4
+    return size
+
+def compile_globs(globs):
+    # one regexp matching any of the fnmatch style globs, None if no glob
+    if not globs:
+        return None
+    return re.compile('|'.join([fnmatch.translate(g.lower())
+                                for g in globs]))
+
+
+class DetachPolicy:
+    """
+    Decide which parts of a message are detached, according to the list
+    settings:
+
+    mlist.detach_min_size: parts smaller than this (bytes) stay inline
+    mlist.detach_max_inline_size: but if the small parts kept inline are
+        more than this in total, the biggest ones are detached anyway
+    mlist.detach_types: only detach those MIME types (globs, 'image/*')
+    mlist.keep_types: never detach those MIME types (globs)
+    mlist.detach_sender_policy: per sender overrides of the above, a dict
+        {'sender@example.com' or '*@example.com': {'min_size': 0, ...}}
+        with min_size, max_inline_size, detach_types or keep_types keys.
+    """
+
+    def __init__(self, min_size=0, max_inline_size=None, detach_types=None,
+                 keep_types=None, sender_policy=None):
+        self.min_size = min_size
+        self.max_inline_size = max_inline_size
+        self.detach_re = compile_globs(detach_types)
+        self.keep_re = compile_globs(keep_types)
+        # [(sender regexp, DetachPolicy)], most specific glob first
+        self.senders = []
+        if sender_policy:
+            settings = {'min_size': min_size,
+                        'max_inline_size': max_inline_size,
+                        'detach_types': detach_types,
+                        'keep_types': keep_types,
+                        }
+            globs = sender_policy.keys()
+            globs.sort(lambda a, b: cmp(len(b), len(a)))
+            for glob in globs:
+                override = settings.copy()
+                override.update(sender_policy[glob])
+                self.senders.append((compile_globs([glob]),
+                                     DetachPolicy(**override)))
+
+    def for_sender(self, msg):
+        # the policy overriden for the sender of msg, or self
+        if self.senders:
+            sender = parseaddr(msg.get('from', ''))[1].lower()
+            for sender_re, policy in self.senders:
+                if sender_re.match(sender):
+                    return policy
+        return self
+
+    def select(self, msg):
+        """
+        Return the id() of the parts of msg to detach.
+        """
+        policy = self.for_sender(msg)
+        selected = {}
+        # small parts kept inline for now, (size, id)
+        small = []
+        inline_size = 0
+        for part in msg.walk():
+            if not is_detachable(part):
+                continue
+            ctype = part.get_content_type()
+            size = estimate_size(part)
+            if (policy.keep_re and policy.keep_re.match(ctype)) or \
+               (policy.detach_re and not policy.detach_re.match(ctype)):
+                debug('> kept by type: %s', ctype)
+                inline_size += size
+            elif size < policy.min_size:
+                small.append((size, id(part)))
+                inline_size += size
+            else:
+                selected[id(part)] = True
+        if policy.max_inline_size is not None:
+            # too much inline, detach the biggest small parts first
+            small.sort()
+            while small and inline_size > policy.max_inline_size:
+                size, partid = small.pop()
+                selected[partid] = True
+                inline_size -= size
+        return selected
+
+def get_policy(mlist):
+    # the DetachPolicy of mlist, compiled again only if its settings changed
+    settings = (getattr(mlist, 'detach_min_size', 0),
+                getattr(mlist, 'detach_max_inline_size', None),
+                getattr(mlist, 'detach_types', None),
+                getattr(mlist, 'keep_types', None),
+                getattr(mlist, 'detach_sender_policy', None),
+                )
+    cached = policies.get(mlist.internal_name())
+    if cached and cached[0] == settings:
+        return cached[1]
+    policy = DetachPolicy(*settings)
+    policies[mlist.internal_name()] = (settings, policy)
+    return policy
+
+def walk_parts(msg, parent=None):
+    # same order as msg.walk(), also giving the parent of each part, None
+    # for msg itself
+    yield parent, msg
+    if msg.is_multipart():
+        for subpart in msg.get_payload():
+            for p in walk_parts(subpart, msg):
+                yield p
+
+def remove_part(parent, part):
+    # remove part from the payload of parent, in place
+    payload = parent.get_payload()
+    for i in range(len(payload)):
+        if payload[i] is part:
+            del payload[i]
+            return
+
+def reset_payload(msg, txt, fname, url):
+    # Reset payload of msg to contents of subpart, and fix up content headers
+    msg.set_payload(txt)
+    del msg['content-type']
+    del msg['content-transfer-encoding']
+    del msg['content-disposition']
+    del msg['content-description']
+    
+    msg.add_header('X-Mailman-Part', 'Attachment-moved', url=url)
+    msg.add_header('Content-Type', 'text/plain', charset='UTF-8', name=fname)
+    msg.add_header('Content-Transfer-Encoding', '8bit')
+    msg.add_header('Content-Disposition', 'attachment', filename=fname)
+    msg.add_header('Content-Description', "Attachment-moved by Mailman")
+
+class FooterRenderer:
+    """
+    The footers of a list, with its templates compiled once: the titles
+    are those of the list language (FOOTER_LANGUAGES), unless the list
+    sets its own:
+
+      mlist.attachment_footer_text = 'Attachments:'
+      mlist.attachment_footer_html = 'Attachments:'
+
+    render() gives the footers of a message in the dict used by
+    add_txt_footer() and add_html_footer().
+    """
+
+    clip_cid = 'part1.clip.12345789'
+
+    def __init__(self, language, text_title=None, html_title=None):
+        strings = FOOTER_LANGUAGES.get(language,
+                                       FOOTER_LANGUAGES[FOOTER_DEFAULT_LANGUAGE])
+        self.units = strings['units']
+        self.text_head = TXT_ATTACHT_REPLACE % {
+            'TITLE': text_title or strings['text_title']}
+        # the holder around the attachments list, split once
+        holder = HTML_ATTACHMENT_HOLDER % {
+            'TITLE': html_title or strings['html_title'],
+            'HTML_HERE': '\0'}
+        self.html_head, self.html_tail = holder.split('\0')
+        self.item_tpl = HTML_ATTACHMENT_CLIP_TPL.replace('%(CID_clip)s',
+                                                         self.clip_cid)
+        # as we replace some content we will have to fight with encoding
+        # set some default list encoding
+        self.lcset = Utils.GetCharSet(language)
+        self.lcset_out = Charset(self.lcset).output_charset or self.lcset
+        # the clip is already base64 encoded above
+        self.clip = MIMEImage(ATTACH_CLIP, 'png',
+                              _encoder=encoders.encode_noop)
+        self.clip['Content-Transfer-Encoding'] = 'base64'
+        self.clip.add_header('Content-ID', '<%s>' % self.clip_cid)
+
+    def get_clip(self):
+        # each message gets its own part, sharing the encoded payload
+        clip = copy.copy(self.clip)
+        clip._headers = self.clip._headers[:]
+        return clip
+
+    def render(self, attachments):
+        text = [self.text_head]
+        html = [self.html_head]
+        for att in attachments:
+            text.append(make_link(att) + '\n')
+            # the name comes from the sender, escaped in the text and in
+            # the attributes, in ASCII so that the footer can be added to
+            # an html part in any charset (see splice_html_footer())
+            replace = {'FNAME_replace': cgi.escape(att['orig'], True).encode(
+                           'ascii', 'xmlcharrefreplace'),
+                       'URL_replace': cgi.escape(att['url'], True),
+                       'SIZE_replace': att['size']}
+            if 'thumb' in att:
+                replace['THUMB_replace'] = cgi.escape(att['thumb'], True)
+                replace['WEB_replace'] = cgi.escape(att.get('web',
+                                                            att['url']), True)
+                html.append(HTML_ATTACHMENT_THUMB_TPL % replace)
+            else:
+                html.append(self.item_tpl % replace)
+        html.append(self.html_tail)
+        return {'footer_attach': ''.join(text),
+                'html_footer_attach': ''.join(html),
+                'clip': self.get_clip(),
+                'lcset': self.lcset,
+                'lcset_out': self.lcset_out,
+                }
+
+def get_renderer(mlist):
+    # the FooterRenderer of mlist, built again only if its settings changed
+    settings = (mlist.preferred_language,
+                getattr(mlist, 'attachment_footer_text', None),
+                getattr(mlist, 'attachment_footer_html', None),
+                )
+    cached = renderers.get(mlist.internal_name())
+    if cached and cached[0] == settings:
+        return cached[1]
+    renderer = FooterRenderer(*settings)
+    renderers[mlist.internal_name()] = (settings, renderer)
+    return renderer
+
+# will be used to write back payload with correct encoding
+FOOTER_CHARSET = Charset('utf-8')
+FOOTER_CHARSET.body_encoding = QP
+
+def get_footer_charset():
+    return FOOTER_CHARSET
+
+def add_txt_footer(msg, data):
+    """
+    Add the list of the moved attachments at the end of the text/plain part
+    msg, in place.
+    """
+    # A normal txt part, add footer to plain text
+    new_footer = data['footer_attach']
+    old_content = to_footer_charset(msg.get_payload(decode=True),
+                                    msg.get_content_charset())
+    debug('old_content:%s, new_footer:%s', \
+        type(old_content), type(new_footer))
+
+    del msg['Content-type']
+    del msg['content-transfer-encoding']
+    msg.set_payload(old_content + new_footer, charset=get_footer_charset())
+
+    debug('add txt footer')
+
+def to_footer_charset(text, charset):
+    # the decoded payload text of a part in charset, converted to the
+    # charset of the rewritten parts, UTF-8. Left as it is without a
+    # charset, or an unknown one
+    if charset in (None, 'us-ascii', 'utf-8'):
+        return text
+    try:
+        return unicode(text, charset, 'replace').encode('utf-8')
+    except LookupError:
+        return text
+
+def add_html_footer(parent, msg, data):
+    """
+    Add the html list of the moved attachments at the end of the text/html
+    part msg, and replace it in parent by a multipart/related containing
+    msg and the clip png it refers to. If parent is already a
+    multipart/related, the clip is simply added to it.
+    """
+    html_footer = data['html_footer_attach']
+    if not splice_html_footer(msg, html_footer):
+        old_content = to_footer_charset(msg.get_payload(decode=True),
+                                        msg.get_content_charset())
+        pos = find_body_end(old_content)
+        if pos is None:
+            debug('no </body>, html footer appended')
+            pos = len(old_content)
+        del msg['content-transfer-encoding']
+        msg.set_payload(''.join((old_content[:pos], html_footer,
+                                 old_content[pos:])),
+                        charset=get_footer_charset())
+    debug('add html footer')
+
+    if parent is None:
+        # a lone html message has no attachment to list, never here
+        return
+    payload = parent.get_payload()
+    for i in range(len(payload)):
+        if payload[i] is msg:
+            break
+    if parent.get_content_type() == 'multipart/related':
+        # don't embbed related twice
+        payload.insert(i + 1, data['clip'])
+    else:
+        related = MIMEMultipart('related')
+        related.attach(msg)
+        related.attach(data['clip'])
+        payload[i] = related
+
+def get_image_settings(mlist, msgdata):
+    """
+    Return the settings of make_derivatives() for mlist, or None if the
+    image derivatives are not wanted: mlist.image_derivatives = 1 enables
+    them, mlist.image_web_size and mlist.image_thumb_size give the longest
+    side in pixels of the web version and of the thumbnail, and
+    mlist.image_quality their JPEG quality.
+    """
+    if not getattr(mlist, 'image_derivatives', 0) \
+            or 'disable_upload' in msgdata:
+        return None
+    if Image is None:
+        debug('image_derivatives needs PIL')
+        return None
+    return (getattr(mlist, 'image_web_size', IMAGE_WEB_SIZE),
+            getattr(mlist, 'image_thumb_size', IMAGE_THUMB_SIZE),
+            getattr(mlist, 'image_quality', IMAGE_QUALITY))
+
+def make_derivatives(path, web_size, thumb_size, quality):
+    """
+    Write next to the saved image path a JPEG thumbnail, path~thumb.jpg,
+    and a web version, path~web.jpg, if the image is bigger than web_size.
+    The saved path is unique (see allocate_attachment_name()), extension
+    included, and '~' never appears in the saved names (see
+    sanitize_fname()), so they can't collide. Return {'thumb': path,
+    'web': path} of those written.
+    """
+    image = Image.open(path)
+    # a JPEG is decoded directly at the smallest scale above web_size
+    image.draft('RGB', (web_size, web_size))
+    image.load()
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    resample = getattr(Image, 'LANCZOS', None) or Image.ANTIALIAS
+    made = {}
+    if max(image.size) > web_size:
+        web = image.copy()
+        web.thumbnail((web_size, web_size), resample)
+        made['web'] = save_derivative(web, path + '~web.jpg', quality)
+    image.thumbnail((thumb_size, thumb_size), resample)
+    made['thumb'] = save_derivative(image, path + '~thumb.jpg', quality)
+    return made
+
+def save_derivative(image, path, quality):
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    image.save(tmp, 'JPEG', quality=quality, optimize=True, progressive=True)
+    os.rename(tmp, path)
+    return path
+
+class DerivativeJob:
+    # an image submitted to the DerivativePool
+
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings = settings
+        self.result = {}
+        self.done = threading.Event()
+
+    def wait(self):
+        # the result of make_derivatives(), {} if it failed
+        self.done.wait()
+        return self.result
+
+
+class DerivativePool:
+    """
+    IMAGE_WORKERS threads making the image derivatives, off the handler
+    thread: the images are submitted while the message is walked and
+    waited for before the upload. Started on first use, in each process.
+    """
+
+    def __init__(self):
+        self.pid = None
+        self.jobs = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.lock.acquire()
+        try:
+            # the threads don't survive a fork
+            if self.pid == os.getpid():
+                return
+            self.jobs = Queue.Queue()
+            for n in range(IMAGE_WORKERS):
+                t = threading.Thread(target=self.work, args=(self.jobs,))
+                t.setDaemon(True)
+                t.start()
+            self.pid = os.getpid()
+        finally:
+            self.lock.release()
+
+    def submit(self, path, settings):
+        self.start()
+        job = DerivativeJob(path, settings)
+        self.jobs.put(job)
+        return job
+
+    def work(self, jobs):
+        while True:
+            job = jobs.get()
+            try:
+                job.result = make_derivatives(job.path, *job.settings)
+            except Exception, e:
+                # not an image PIL can read, or a broken one
+                syslog('error', 'AttachmentMove: derivatives of %s: %s',
+                       job.path, e)
+            job.done.set()
+
+# the derivatives of the images of all the lists
+derivative_pool = DerivativePool()
+
+def find_body_end(html):
+    """
+    Return the position of the last </body> tag of html, in any case, or
+    None. Scanned backward from the end, where it is.
+    """
+    end = len(html)
+    while True:
+        i = html.rfind('</', 0, end)
+        if i < 0:
+            return None
+        if html[i+2:i+6].lower() == 'body' and \
+                html[i+6:i+7] in ('>', ' ', '\t', '\r', '\n'):
+            return i
+        end = i
+
+def splice_html_footer(msg, html_footer):
+    """
+    Insert the ascii html_footer in the still encoded payload of msg, a
+    7bit, 8bit or quoted-printable html part, which keeps its charset and
+    encoding. Return False if it can't be done this way.
+    """
+    cte = msg.get('content-transfer-encoding', '7bit').strip().lower()
+    if cte not in ('7bit', '8bit', 'quoted-printable'):
+        return False
+    try:
+        html_footer.decode('ascii')
+    except UnicodeError:
+        return False
+    payload = msg.get_payload()
+    pos = find_body_end(payload)
+    if cte == 'quoted-printable':
+        if pos is None:
+            # maybe cut by a soft line break
+            return False
+        html_footer = quopri.encodestring(html_footer)
+    elif pos is None:
+        debug('no </body>, html footer appended')
+        pos = len(payload)
+    msg.set_payload(''.join((payload[:pos], html_footer, payload[pos:])))
+    return True
+
+def make_link(att):
+    # the text footer is UTF-8
+    return att['orig'].encode('utf-8') + ' <' + att['url']  + '> (' + \
+           att['size'] + ')'
+
+def sizeof_fmt(num, units=None):
+    if units is None:
+        units = FOOTER_LANGUAGES[FOOTER_DEFAULT_LANGUAGE]['units']
+    for x in units:
+        if num < 1024.0:
+            return "%3.1f %s" % (num, x)
+        num /= 1024.0
+
+def guess_extension(ctype, ext):
+    # mimetypes maps multiple extensions to the same type, e.g. .doc, .dot,
+    # and .wiz are all mapped to application/msword.  This sucks for finding
+    # the best reverse mapping.  If the extension is one of the giving
+    # mappings, we'll trust that, otherwise we'll just guess. :/
+    # guess_all_extensions() goes through all the known types, remember.
+    try:
+        return guessed_extensions[ctype, ext]
+    except KeyError:
+        pass
+    all = guess_all_extensions(ctype, strict=False)
+    if ext in all:
+        guessed = ext
+    else:
+        guessed = all and all[0]
+    if len(guessed_extensions) >= GUESSED_EXTENSIONS_MAX:
+        guessed_extensions.clear()
+    guessed_extensions[ctype, ext] = guessed
+    return guessed
+
+
+def safe_strftime(fmt, t):
+    try:
+        return time.strftime(fmt, t)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def calculate_attachments_dir(mlist, msg, msgdata):
+    # Calculate the directory that attachments for this message will go
+    # under, according to mlist.attachment_layout:
+    #  'flat': attachments-moved/<files> (the default)
+    #  'date': attachments-moved/YYYYMMDD/<files>
+    #  'hash': attachments-moved/<msgid-hash[:2]>/<msgid-hash[2:4]>/<files>
+    layout = getattr(mlist, 'attachment_layout', 'flat')
+    if layout == 'date':
+        return os.path.join(ATTACHMENTS_DIR, calculate_datedir(msg, msgdata))
+    elif layout == 'hash':
+        # As for the msgid hash, we'll base this part on the Message-ID: so
+        # that all attachments for the same message end up in the same
+        # directory (we'll uniquify the filenames in that directory as
+        # needed).
+        msgid = msg['message-id']
+        if msgid is None:
+            msgid = msg['Message-ID'] = Utils.unique_message_id(mlist)
+        digest = sha_new(msgid).hexdigest()
+        return os.path.join(ATTACHMENTS_DIR, digest[:2], digest[2:4])
+    elif layout <> 'flat':
+        syslog('error', 'AttachmentMove: unknown attachment_layout %s',
+               layout)
+    return ATTACHMENTS_DIR
+
+def calculate_datedir(msg, msgdata):
+    # Start by calculating the date-based component.
+    fmt = '%Y%m%d'
+    datestr = msg.get('Date')
+    if datestr:
+        now = parsedate(datestr)
+    else:
+        now = time.gmtime(msgdata.get('received_time', time.time()))
+    datedir = safe_strftime(fmt, now)
+    if not datedir:
+        datestr = msgdata.get('X-List-Received-Date')
+        if datestr:
+            datedir = safe_strftime(fmt, datestr)
+    if not datedir:
+        # What next?  Unixfrom, I guess.
+        parts = msg.get_unixfrom().split()
+        try:
+            month = {'Jan':1, 'Feb':2, 'Mar':3, 'Apr':4, 'May':5, 'Jun':6,
+                     'Jul':7, 'Aug':8, 'Sep':9, 'Oct':10, 'Nov':11, 'Dec':12,
+                     }.get(parts[3], 0)
+            day = int(parts[4])
+            year = int(parts[6])
+        except (IndexError, ValueError):
+            # Best we can do I think
+            month = day = year = 0
+        datedir = '%04d%02d%02d' % (year, month, day)
+    assert datedir
+    return datedir
+
+
+def makedirs(dir):
+    # Create all the directories to store this attachment in
+    try:
+        os.makedirs(dir, 02775)
+        # Unfortunately, FreeBSD seems to be broken in that it doesn't honor
+        # the mode arg of mkdir().
+        def twiddle(arg, dirname, names):
+            os.chmod(dirname, 02775)
+        os.path.walk(dir, twiddle, None)
+    except OSError, e:
+        if e.errno <> errno.EEXIST: raise
+
+import unicodedata
+
+# letters that NFKD doesn't split into an ASCII letter and accents, spelled
+# in ASCII by remove_accents(), so names like Grüße or Færøerne stay
+# readable
+TRANSLITERATIONS = {
+    u'ß': u'ss', u'ẞ': u'SS', u'æ': u'ae', u'Æ': u'AE', u'œ': u'oe',
+    u'Œ': u'OE', u'ø': u'o', u'Ø': u'O', u'đ': u'd', u'Đ': u'D',
+    u'ð': u'd', u'Ð': u'D', u'þ': u'th', u'Þ': u'TH', u'ł': u'l',
+    u'Ł': u'L', u'ı': u'i', u'ħ': u'h', u'Ħ': u'H', u'ŋ': u'ng',
+    u'Ŋ': u'NG', u'–': u'-', u'—': u'-', u'€': u'EUR',
+    }
+# the Cyrillic and Greek small letters left by NFKD (й is и, ё is е, έ is
+# ε...), the capitals are added below
+SCRIPT_LETTERS = zip(
+    u'абвгдежзиклмнопрстуфхцчшщъыьэюяєіґђјљњћџѕ'
+    u'αβγδεζηθικλμνξοπρσςτυφχψω',
+    ['a', 'b', 'v', 'g', 'd', 'e', 'zh', 'z', 'i', 'k', 'l', 'm', 'n', 'o',
+     'p', 'r', 's', 't', 'u', 'f', 'kh', 'ts', 'ch', 'sh', 'shch', '', 'y',
+     '', 'e', 'yu', 'ya', 'ye', 'i', 'g', 'dj', 'j', 'lj', 'nj', 'c', 'dz',
+     'dz',
+     'a', 'v', 'g', 'd', 'e', 'z', 'i', 'th', 'i', 'k', 'l', 'm', 'n', 'x',
+     'o', 'p', 'r', 's', 's', 't', 'y', 'f', 'ch', 'ps', 'o'])
+for c, t in SCRIPT_LETTERS:
+    TRANSLITERATIONS[c] = unicode(t)
+    TRANSLITERATIONS[c.upper()] = unicode(t.capitalize())
+TRANSLITERATIONS = dict([(ord(c), t) for c, t in TRANSLITERATIONS.items()])
+
+def remove_accents(input_str):
+    # the ASCII spelling of input_str, as far as it goes: by unidecode if
+    # installed, else the accents are removed and the letters of
+    # TRANSLITERATIONS spelled, the others are left to the caller
+    if not isinstance(input_str, unicode):
+        input_str = unicode(input_str)
+    if unidecode is not None:
+        return unicode(unidecode(input_str))
+    nkfd_form = unicodedata.normalize('NFKD', input_str)
+    return u"".join([c for c in nkfd_form if not unicodedata.combining(c)]
+                    ).translate(TRANSLITERATIONS)
+
+def get_attachment_fname(mlist, msg):
+    return PartInfo(msg, get_renderer(mlist).lcset).fname
+
+def sanitize_fname(filename, ctype):
+    """
+    Split filename, as returned by get_attachment_fname(), into the base
+    name and the extension of the stored file, with only alphanumerics,
+    dash, underscore and dot left. The extension is guessed from ctype when
+    the name has none.
+    """
+    filename, fnext = os.path.splitext(filename)
+    if not fnext and filename.startswith('.'):
+        # only the extension of a name without ASCII spelling is left
+        filename, fnext = '', filename
+    # HTML message doesn't have filename :-(
+    ext = fnext or guess_extension(ctype, fnext)
+    if not ext:
+        # We don't know what it is, so assume it's just a shapeless
+        # application/octet-stream, unless the Content-Type: is
+        # message/rfc822, in which case we know we'll coerce the type to
+        # text/plain below.
+        if ctype == 'message/rfc822':
+            ext = '.txt'
+        else:
+            ext = '.bin'
+    # Allow only alphanumerics, dash, underscore, and dot
+    ext = sre.sub('', ext)
+    # Now base the filename on what's in the attachment, uniquifying it if
+    # necessary.
+    if not filename:
+        filebase = 'attachment'
+    else:
+        # Sanitize the filename given in the message headers
+        parts = pre.split(filename)
+        filename = parts[-1]
+        # Strip off leading dots
+        filename = dre.sub('', filename)
+        # Allow only alphanumerics, dash, underscore, and dot
+        filename = sre.sub('', filename)
+        # If the filename's extension doesn't match the type we guessed,
+        # which one should we go with?  For now, let's go with the one we
+        # guessed so attachments can't lie about their type.  Also, if the
+        # filename /has/ no extension, then tack on the one we guessed.
+        # The extension was removed from the name above.
+        filebase = filename or 'attachment'
+    return filebase, ext
+
+
+class PartInfo:
+    """
+    An attachment part and what the handler needs of it, each computed on
+    first use only: title, the file name of its headers in unicode, shown
+    in the footers; fname, its ASCII spelling (see remove_accents());
+    filebase and ext, the name of the stored file, see sanitize_fname().
+    lcset is the list charset, for the undecodable names. ctype is its
+    content type, size its decoded size, set once spool_attachment() has
+    decoded it.
+    """
+
+    def __init__(self, part, lcset, ctype=None):
+        self.part = part
+        self.lcset = lcset
+        if ctype is None:
+            ctype = part.get_content_type()
+        self.ctype = ctype
+        self.size = None
+
+    def __getattr__(self, name):
+        if name == 'title':
+            # i18n file name is encoded (RFC 2047 or 2231), decoded to
+            # unicode, not to the list charset which may not have its
+            # letters
+            filename = Utils.oneline(self.part.get_filename(''), self.lcset,
+                                     in_unicode=True)
+            if isinstance(filename, str):
+                # oneline() gives an undecodable header back as it is
+                filename = unicode(filename, self.lcset, 'replace')
+            self.title = filename
+        elif name == 'fname':
+            # what has no ASCII spelling is dropped, sanitize_fname() names
+            # what is left without a base 'attachment'
+            self.fname = remove_accents(self.title).encode('ascii', 'ignore')
+        elif name in ('filebase', 'ext'):
+            self.filebase, self.ext = sanitize_fname(self.fname, self.ctype)
+        else:
+            raise AttributeError(name)
+        return self.__dict__[name]
+
+
+def archive_process(mlist, msg, msgdata):
+    """
+    The companion handler AttachmentMoveArchive, in place of ToArchive in
+    the pipeline: the files stored by AttachmentMove are hard linked in the
+    list archive, where Scrubber would have written them, attachments/
+    YYYYMMDD/<msgid hash>/, instead of being decoded and written again. The
+    archive keeps them when the local copy is emptied or the remote one
+    deleted (see gc_attachments()). Their archive url is added to the
+    msgdata['moved_attachments'] entries, as 'archive_url', and a copy of
+    the message linking to them is handed to ToArchive; the members still
+    get the links to the remote storage.
+    """
+    moved = msgdata.get('moved_attachments')
+    # same short circuits as ToArchive
+    if not moved or msgdata.get('isdigest') or not mlist.archive \
+            or msg.get('x-no-archive', '').lower() == 'yes' \
+            or msg.get('x-archive', '').lower() == 'no':
+        ToArchive.process(mlist, msg, msgdata)
+        return
+    # the same as Scrubber.calculate_attachments_dir()
+    msgid = msg['message-id']
+    if msgid is None:
+        msgid = msg['Message-ID'] = Utils.unique_message_id(mlist)
+    digest = sha_new(msgid).hexdigest()
+    dir = os.path.join('attachments', calculate_datedir(msg, msgdata),
+                       digest[:4] + digest[-4:])
+    fsdir = os.path.join(mlist.archive_dir(), dir)
+    baseurl = mlist.GetBaseArchiveURL()
+    if baseurl[-1] <> '/':
+        baseurl += '/'
+    for entry in moved:
+        if not entry['path']:
+            continue
+        fname = os.path.basename(entry['path'])
+        path = os.path.join(fsdir, fname)
+        makedirs(fsdir)
+        try:
+            os.link(entry['path'], path)
+        except OSError, e:
+            if e.errno == errno.EEXIST:
+                # done by a previous run of the pipeline
+                pass
+            elif e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                shutil.copyfile(entry['path'], path)
+            else:
+                raise
+        entry['archive_url'] = baseurl + '%s/%s' % (dir, fname)
+        debug('archived: %s', path)
+    ToArchive.process(mlist, relink_message(msg, moved), msgdata)
+
+def relink_message(msg, moved):
+    """
+    Return a copy of msg whose text and html parts link to the
+    'archive_url' of the moved entries instead of their 'url'.
+    """
+    urls = {}
+    for entry in moved:
+        if entry.get('archive_url') and entry['url']:
+            urls[entry['url']] = entry['archive_url']
+    msg = copy.deepcopy(msg)
+    if not urls:
+        return msg
+    # longest first, the url of a thumbnail starts with the url of its image
+    keys = urls.keys()
+    keys.sort(lambda a, b: cmp(len(b), len(a)))
+    url_re = re.compile('|'.join(map(re.escape, keys)))
+    for part in msg.walk():
+        if part.get_content_type() not in ('text/plain', 'text/html'):
+            continue
+        text = part.get_payload(decode=True)
+        new = url_re.sub(lambda m: urls[m.group(0)], text)
+        if new <> text:
+            # encoded again as set_payload() likes for the charset
+            del part['content-transfer-encoding']
+            part.set_payload(new, part.get_content_charset('us-ascii'))
+    return msg
+
+def reshard_attachments(mlist, layout=None, dryrun=0):
+    """
+    Move the files stored flat in attachments-moved/ to the sub folders of
+    layout ('date' or 'hash', mlist.attachment_layout by default), to be
+    run once after changing the layout of a list:
+
+      withlist -l -r Mailman.Handlers.AttachmentMove.reshard_attachments \\
+        listname date
+
+    The remote copies keep their names, so the links in the messages
+    already sent stay valid. Pending upload jobs are updated with the new
+    local paths; stop the uploader (drain_upload_spool) while it runs.
+    As the message is not known anymore, the date layout uses the file
+    modification time and the hash layout the hash of the file name.
+    """
+    if layout is None:
+        layout = getattr(mlist, 'attachment_layout', 'flat')
+    if layout not in ('date', 'hash'):
+        print 'nothing to do for layout %s' % layout
+        return
+    root = os.path.join(mlist.archive_dir(), ATTACHMENTS_DIR)
+    moved = {}
+    for fname in sorted(os.listdir(root)):
+        path = os.path.join(root, fname)
+        # skip our hidden files and the old lock
+        if fname.startswith('.') or fname.startswith('attachments.lock') \
+                or not os.path.isfile(path):
+            continue
+        if layout == 'date':
+            subdir = time.strftime('%Y%m%d',
+                                   time.gmtime(os.path.getmtime(path)))
+        else:
+            digest = sha_new(fname).hexdigest()
+            subdir = os.path.join(digest[:2], digest[2:4])
+        fsdir = os.path.join(root, subdir)
+        if dryrun:
+            print '%s -> %s' % (fname, subdir)
+            continue
+        makedirs(fsdir)
+        newpath = os.path.join(fsdir, fname)
+        try:
+            os.link(path, newpath)
+            os.unlink(path)
+        except OSError, e:
+            if e.errno <> errno.EEXIST: raise
+            # keep the name unless the shard already has it
+            filebase, ext = os.path.splitext(fname)
+            newpath, extra = allocate_attachment_name(fsdir, filebase, ext,
+                                                      path)
+        moved[path] = newpath
+    if moved:
+        update_spool_paths(mlist, moved)
+        index_update_paths(moved)
+    print '%s: %d files moved to the %s layout' % (
+        mlist.internal_name(), len(moved), layout)
+
+def decode_payload(msg, fp):
+    """
+    Write the decoded payload of msg to the file fp, working on
+    DECODE_BLOCK_SIZE bytes of encoded text at a time, so the decoded content
+    is never held in memory as a whole. Return the decoded size and its
+    SHA-256 hex digest.
+    """
+    payload = msg.get_payload()
+    cte = msg.get('content-transfer-encoding', '').lower()
+    h = hashlib.sha256()
+    size = 0
+    # undecoded text left from the previous block
+    carry = ''
+    for i in range(0, len(payload), DECODE_BLOCK_SIZE):
+        block = carry + payload[i:i+DECODE_BLOCK_SIZE]
+        if cte == 'base64':
+            # decode whole groups of 4 chars only
+            block = ''.join(block.split())
+            cut = len(block) - len(block) % 4
+            block, carry = block[:cut], block[cut:]
+            data = binascii.a2b_base64(block)
+        elif cte == 'quoted-printable':
+            # decode whole lines only, soft line breaks included
+            cut = block.rfind('\n') + 1
+            block, carry = block[:cut], block[cut:]
+            data = quopri.decodestring(block)
+        else:
+            data = block
+        fp.write(data)
+        h.update(data)
+        size += len(data)
+    if carry:
+        if cte == 'base64':
+            # broken padding, same tolerance as the email package
+            data = binascii.a2b_base64(carry + '===')
+        else:
+            data = quopri.decodestring(carry)
+        fp.write(data)
+        h.update(data)
+        size += len(data)
+    return size, h.hexdigest()
+
+def spool_attachment(mlist, msg, dir):
+    # decode the attachment to a hidden temporary file in the attachment
+    # folder, save_attachment() gives it its final name. Return the file
+    # name, the decoded size and the SHA-256 hex digest.
+    fsdir = os.path.join(mlist.archive_dir(), dir)
+    makedirs(fsdir)
+    tmpfile = os.path.join(fsdir, '.tmp-%d-%s' % (
+        os.getpid(), binascii.hexlify(os.urandom(6))))
+    # like open(), respect the umask so the web server can read it
+    fd = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+    fp = os.fdopen(fd, 'wb')
+    try:
+        cte = msg.get('content-transfer-encoding', '').lower()
+        if cte in ('x-uuencode', 'uuencode', 'uue', 'x-uue'):
+            # rare, let the email package handle it
+            data = msg.get_payload(decode=True)
+            fp.write(data)
+            size, digest = len(data), hashlib.sha256(data).hexdigest()
+        else:
+            try:
+                size, digest = decode_payload(msg, fp)
+            except binascii.Error:
+                # garbage in the base64, the email package is more lenient
+                fp.seek(0)
+                fp.truncate()
+                data = msg.get_payload(decode=True)
+                fp.write(data)
+                size, digest = len(data), hashlib.sha256(data).hexdigest()
+    except:
+        fp.close()
+        os.unlink(tmpfile)
+        raise
+    fp.close()
+    return tmpfile, size, digest
+
+def allocate_attachment_name(fsdir, filebase, ext, tmpfile):
+    """
+    Give tmpfile a unique name in fsdir, filebase.ext or filebase-cnt.ext,
+    and return the new path and the counter suffix used.
+
+    os.link() fails if the name exists, so concurrent runners can't take the
+    same name and no lock is needed (unlike O_EXCL, link is atomic on NFS
+    too). The last counter used for each name is kept in .counters/ as a
+    hint where to start from, avoiding a probe of every existing copy of
+    popular names. A stale hint only costs a few more link() calls.
+    """
+    hintdir = os.path.join(fsdir, '.counters')
+    hintfile = os.path.join(hintdir, filebase + ext)
+    try:
+        fp = open(hintfile)
+        try:
+            counter = int(fp.read() or 0) + 1
+        finally:
+            fp.close()
+    except (IOError, ValueError):
+        counter = 0
+    while True:
+        if counter:
+            extra = '-%04d' % counter
+        else:
+            extra = ''
+        path = os.path.join(fsdir, filebase + extra + ext)
+        try:
+            os.link(tmpfile, path)
+            break
+        except OSError, e:
+            if e.errno <> errno.EEXIST: raise
+            counter += 1
+    os.unlink(tmpfile)
+    # `path' now contains the unique filename for the attachment.
+    makedirs(hintdir)
+    tmphint = '%s.%d.tmp' % (hintfile, os.getpid())
+    fp = open(tmphint, 'w')
+    try:
+        fp.write('%d\n' % counter)
+    finally:
+        fp.close()
+    os.rename(tmphint, hintfile)
+    return path, extra
+
+def save_attachment(mlist, msg, dir, tmpfile=None, info=None):
+    # attachment is extracted from the message part pointed by msg and stored
+    # to standard mailman attachement dir. See Mailman/Handlers/Scrubber.py 
+    # where this code come from. Scrubber specific behavior have been removed
+    # the return value is a composed pair, physical filename and it's mailman's
+    # list url. Not used by this handler, see ftp_upload_attchment().
+    # tmpfile is the content already decoded by spool_attachment(), info
+    # the PartInfo of msg if the caller has it.
+    fsdir = os.path.join(mlist.archive_dir(), dir)
+    makedirs(fsdir)
+    # Figure out the attachment type and get the decoded data
+    if tmpfile is None:
+        tmpfile, size, digest = spool_attachment(mlist, msg, dir)
+    if info is None:
+        info = PartInfo(msg, get_renderer(mlist).lcset)
+    # BAW: mimetypes ought to handle non-standard, but commonly found types,
+    # e.g. image/jpg (should be image/jpeg).  For now we just store such
+    # things as application/octet-streams since that seems the safest.
+    filebase, ext = info.filebase, info.ext
+    path, extra = allocate_attachment_name(fsdir, filebase, ext, tmpfile)
+    # Now calculate the url
+    baseurl = mlist.GetBaseArchiveURL()
+    # Private archives will likely have a trailing slash.  Normalize.
+    if baseurl[-1] <> '/':
+        baseurl += '/'
+    # A trailing space in url string may save users who are using
+    # RFC-1738 compliant MUA (Not Mozilla).
+    # Trailing space will definitely be a problem with format=flowed.
+    # Bracket the URL instead.
+    url = baseurl + '%s/%s%s%s' % (dir, filebase, extra, ext)
+    return path, url
+
+def get_dedup_dir(mlist):
+    # one index per remote location, shared by the lists uploading there
+    base = sha_new(mlist.remote_http_base).hexdigest()[:16]
+    return os.path.join(mm_cfg.DATA_DIR, 'attachmentmove-dedup', base)
+
+def get_dedup_entry(mlist, digest):
+    # fan out on the first digest byte to keep folders small
+    return os.path.join(get_dedup_dir(mlist), digest[:2], digest)
+
+def dedup_lookup(mlist, digest):
+    # return the remote name of an already hosted content, or None
+    try:
+        fp = open(get_dedup_entry(mlist, digest))
+    except IOError, e:
+        if e.errno <> errno.ENOENT: raise
+        return None
+    try:
+        return fp.read().strip() or None
+    finally:
+        fp.close()
+
+def dedup_record(mlist, digest, remote_fname):
+    # entries are written atomically, concurrent runners storing the same
+    # content both write a valid name, the last one wins.
+    entry = get_dedup_entry(mlist, digest)
+    makedirs(os.path.dirname(entry))
+    tmp = '%s.%d.tmp' % (entry, os.getpid())
+    fp = open(tmp, 'w')
+    try:
+        fp.write(remote_fname + '\n')
+    finally:
+        fp.close()
+    os.rename(tmp, entry)
+
+def dedup_count(mlist, hits, misses):
+    # update the hit/miss counters, once per message
+    statsfile = os.path.join(get_dedup_dir(mlist), 'stats.pck')
+    makedirs(get_dedup_dir(mlist))
+    lock = LockFile.LockFile(statsfile + '.lock')
+    lock.lock()
+    try:
+        stats = load_dedup_stats(statsfile)
+        stats['hits'] += hits
+        stats['misses'] += misses
+        fp = open(statsfile + '.tmp', 'wb')
+        try:
+            cPickle.dump(stats, fp, 1)
+        finally:
+            fp.close()
+        os.rename(statsfile + '.tmp', statsfile)
+    finally:
+        lock.unlock()
+
+def load_dedup_stats(statsfile):
+    try:
+        fp = open(statsfile, 'rb')
+    except IOError, e:
+        if e.errno <> errno.ENOENT: raise
+        return {'hits': 0, 'misses': 0}
+    try:
+        return cPickle.load(fp)
+    finally:
+        fp.close()
+
+def dedup_status(mlist):
+    """
+    Print and return the hits, misses and hit rate of the deduplication
+    index used by mlist:
+
+      withlist -r Mailman.Handlers.AttachmentMove.dedup_status listname
+    """
+    stats = load_dedup_stats(os.path.join(get_dedup_dir(mlist), 'stats.pck'))
+    total = stats['hits'] + stats['misses']
+    rate = 0.0
+    if total:
+        rate = 100.0 * stats['hits'] / total
+    print '%s: %d hits, %d misses, %.1f%% hit rate' % (
+        mlist.remote_http_base, stats['hits'], stats['misses'], rate)
+    return stats['hits'], stats['misses'], rate
+
+# the index connection of this process, with its pid, a forked child opens
+# its own
+index_db = None
+
+def get_index():
+    """
+    Return the sqlite connection to the index of the detached parts, or
+    None if it is disabled. The database is in WAL mode: the runners
+    write, the tools read, without blocking each other.
+    """
+    global index_db
+    path = getattr(mm_cfg, 'ATTACHMENTMOVE_INDEX', INDEX_FILE)
+    if not path:
+        return None
+    if index_db and index_db[0] == os.getpid():
+        return index_db[1]
+    conn = sqlite3.connect(path, timeout=30)
+    tries = INDEX_SETUP_TRIES
+    while True:
+        try:
+            setup_index(conn)
+            break
+        except sqlite3.OperationalError, e:
+            # another process creating the schema at the same time, the
+            # first runners after an upgrade or the retro_process()
+            # workers: "database schema has changed", or the column
+            # already added
+            tries -= 1
+            if tries <= 0:
+                raise
+            debug('index setup: %s, trying again', e)
+            time.sleep(0.1)
+    index_db = (os.getpid(), conn)
+    return conn
+
+def setup_index(conn):
+    # create or upgrade the schema of the index
+    conn.execute('PRAGMA journal_mode=WAL')
+    # a commit doesn't wait for the disk in WAL mode, a crash may lose the
+    # last ones but never corrupts the database
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS attachments (
+            id INTEGER PRIMARY KEY,
+            list TEXT NOT NULL,
+            message_id TEXT,
+            date INTEGER NOT NULL,
+            filename TEXT,
+            path TEXT,
+            url TEXT,
+            remote TEXT,
+            size INTEGER,
+            hash TEXT,
+            pruned INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS attachments_list_date
+            ON attachments (list, date);
+        CREATE INDEX IF NOT EXISTS attachments_message_id
+            ON attachments (message_id);
+        CREATE INDEX IF NOT EXISTS attachments_hash ON attachments (hash);
+        CREATE INDEX IF NOT EXISTS attachments_url ON attachments (url);
+        CREATE INDEX IF NOT EXISTS attachments_remote
+            ON attachments (remote);
+        CREATE INDEX IF NOT EXISTS attachments_path ON attachments (path);
+        """)
+    # the time the remote copy was deleted by gc_attachments(), added later
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(attachments)')]
+    if 'pruned' not in columns:
+        conn.execute('ALTER TABLE attachments ADD COLUMN pruned INTEGER')
+
+def get_message_date(msg):
+    # the Date: of msg in seconds since the epoch, or now
+    date = msg.get('date')
+    if date:
+        parsed = parsedate_tz(date)
+        if parsed:
+            try:
+                return int(mktime_tz(parsed))
+            except (OverflowError, ValueError):
+                pass
+    return int(time.time())
+
+def index_record(mlist, msg, rows):
+    """
+    Record the parts detached from msg, rows of (filename, local path,
+    url, remote name, size, hash), in one transaction. A failure is
+    logged, the message goes on.
+    """
+    if not rows:
+        return
+    try:
+        conn = get_index()
+        if conn is None:
+            return
+        head = (mlist.internal_name(), msg.get('message-id'),
+                get_message_date(msg))
+        conn.executemany(
+            'INSERT INTO attachments (list, message_id, date, filename, '
+            'path, url, remote, size, hash) VALUES (?,?,?,?,?,?,?,?,?)',
+            [head + row for row in rows])
+        conn.commit()
+    except sqlite3.Error, e:
+        syslog('error', 'AttachmentMove: index %s: %s',
+               mlist.internal_name(), e)
+
+def index_update_paths(moved):
+    # the local copies moved by reshard_attachments(), {old: new}
+    conn = get_index()
+    if conn is None:
+        return
+    conn.executemany('UPDATE attachments SET path = ? WHERE path = ?',
+                     [(new, old) for old, new in moved.items()])
+    conn.commit()
+
+def index_last_id():
+    # the id of the last row of the index, 0 if empty or disabled
+    conn = get_index()
+    if conn is None:
+        return 0
+    return conn.execute('SELECT MAX(id) FROM attachments').fetchone()[0] or 0
+
+def parse_day(day):
+    # 'YYYY-MM-DD' (local time) to seconds since the epoch
+    return int(time.mktime(time.strptime(day, '%Y-%m-%d')))
+
+def print_index_rows(rows):
+    for row in rows:
+        print '%s %s %s %s %s' % (
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(row['date'])),
+            row['message_id'], row['filename'], row['size'], row['url'])
+
+def find_attachment_messages(mlist, ref):
+    """
+    Return and print the messages referencing a stored file, ref being
+    its url, remote name, local path or content hash (SHA-256 hex). As the
+    same content is shared when attachment_dedup is on, all the lists are
+    searched:
+
+      withlist -r Mailman.Handlers.AttachmentMove.find_attachment_messages \
+        listname http://example.com/doc.pdf
+    """
+    conn = get_index()
+    if conn is None:
+        print 'the attachment index is disabled'
+        return []
+    conn.row_factory = sqlite3.Row
+    rows = conn.execute(
+        'SELECT * FROM attachments WHERE url = ? OR remote = ? OR path = ? '
+        'OR hash = ? ORDER BY date', (ref, ref, ref, ref)).fetchall()
+    # the hash of a remote name known to the index, the derivatives of an
+    # image have none
+    hashes = set([row['hash'] for row in rows])
+    if len(hashes) == 1 and ref not in hashes and None not in hashes:
+        rows = conn.execute(
+            'SELECT * FROM attachments WHERE hash = ? ORDER BY date',
+            (hashes.pop(),)).fetchall()
+    print_index_rows(rows)
+    return rows
+
+def list_attachments(mlist, since=None, until=None):
+    """
+    Return and print the parts detached from the messages of the list
+    dated from since to until included ('YYYY-MM-DD', both optional):
+
+      withlist -r Mailman.Handlers.AttachmentMove.list_attachments \
+        listname 2014-05-01 2014-05-31
+    """
+    conn = get_index()
+    if conn is None:
+        print 'the attachment index is disabled'
+        return []
+    conn.row_factory = sqlite3.Row
+    start = 0
+    end = sys.maxint
+    if since:
+        start = parse_day(since)
+    if until:
+        end = parse_day(until) + 24 * 3600 - 1
+    rows = conn.execute(
+        'SELECT * FROM attachments WHERE list = ? AND date BETWEEN ? AND ? '
+        'ORDER BY date', (mlist.internal_name(), start, end)).fetchall()
+    print_index_rows(rows)
+    return rows
+
+def ftp_pool_key(mlist):
+    # pooled sessions are only shared between lists using the same account
+    # and the same remote folder, as the session stays cwd'ed in it.
+    return (mlist.ftp_remote_host,
+            getattr(mlist, 'ftp_remote_port', 21),
+            mlist.ftp_remote_login,
+            getattr(mlist, 'ftp_remote_dir', None))
+
+def ftp_connect(mlist):
+    # open a new authenticated session, positioned in ftp_remote_dir
+    host = mlist.ftp_remote_host
+    port = getattr(mlist, 'ftp_remote_port', 21)
+    debug('ftp connect to %s:%s', host, port)
+
+    timeouts = get_timeouts(mlist)
+
+    # try secure ftp first
+    retry_login = 0
+    ftp = ftp_open(ftplib.FTP_TLS, host, port, timeouts)
+
+    try:
+        ftp.login(mlist.ftp_remote_login, mlist.ftp_remote_pass)
+        ftp.prot_p()
+    except ftplib.error_perm:
+        retry_login = 1
+        ftp.quit()
+        # fall back to normal FTP
+        ftp = ftp_open(ftplib.FTP, host, port, timeouts)
+
+    if retry_login:
+        ftp.login(mlist.ftp_remote_login, mlist.ftp_remote_pass)
+
+    if hasattr(mlist, 'ftp_remote_dir'):
+        # missing folder or wrong path will raise exception
+        ftp.cwd(mlist.ftp_remote_dir)
+
+    return ftp
+
+def get_timeouts(mlist):
+    # (connect, transfer) timeouts in seconds for the remote storage
+    return (getattr(mlist, 'remote_connect_timeout', REMOTE_CONNECT_TIMEOUT),
+            getattr(mlist, 'remote_transfer_timeout', REMOTE_TRANSFER_TIMEOUT))
+
+def ftp_open(cls, host, port, timeouts):
+    ftp = cls()
+    ftp.connect(host, port, timeouts[0])
+    # then the control and data connections wait up to the transfer timeout
+    ftp.timeout = timeouts[1]
+    ftp.sock.settimeout(timeouts[1])
+    return ftp
+
+def ftp_close(ftp):
+    # close a session we don't trust anymore, ignoring any error
+    try:
+        ftp.quit()
+    except ftplib.all_errors:
+        ftp.close()
+
+
+class ConnectionPool:
+    """
+    Keep connections alive between uploads, so the connect, TLS handshake
+    and login are paid once per runner process instead of once per
+    attachment. Connections are checked before being reused and dropped
+    after some idle time. Subclasses define how to open, check and close a
+    connection to a target, and which targets can share connections.
+    """
+
+    def __init__(self):
+        # key -> list of (conn, last_used)
+        self.idle = {}
+        # upload workers share the pool
+        self.lock = threading.Lock()
+
+    def key(self, target):
+        return target
+
+    def connect(self, target):
+        raise NotImplementedError
+
+    def check(self, conn):
+        return True
+
+    def close(self, conn):
+        conn.close()
+
+    def idle_timeout(self, target):
+        raise NotImplementedError
+
+    def acquire(self, target):
+        # return a live connection for target, and whether it was reused
+        key = self.key(target)
+        while True:
+            conn = self.pop(key)
+            if conn is None:
+                start = time.time()
+                conn = self.connect(target)
+                metrics.timing('connect', time.time() - start)
+                return conn, False
+            if self.check(conn):
+                return conn, True
+
+    def pop(self, key):
+        # take an idle connection out of the pool, None if there is none
+        self.lock.acquire()
+        try:
+            self.expire()
+            conns = self.idle.get(key)
+            if conns:
+                return conns.pop()[0]
+            return None
+        finally:
+            self.lock.release()
+
+    def release(self, target, conn):
+        # give back a connection after a successful transfer
+        timeout = self.idle_timeout(target)
+        if timeout <= 0:
+            self.close(conn)
+            return
+        # remember the timeout with the connection, lists can differ
+        conn.pool_idle_timeout = timeout
+        key = self.key(target)
+        self.lock.acquire()
+        try:
+            # also close the sessions left since the previous messages, a
+            # runner can go a long time without taking a connection
+            self.expire()
+            self.idle.setdefault(key, []).append((conn, time.time()))
+        finally:
+            self.lock.release()
+
+    def expire(self):
+        # close connections idle for too long, the server would drop them
+        # anyway. called with the lock held
+        now = time.time()
+        for key, conns in self.idle.items():
+            keep = []
+            for conn, last_used in conns:
+                if now - last_used > conn.pool_idle_timeout:
+                    self.close(conn)
+                else:
+                    keep.append((conn, last_used))
+            if keep:
+                self.idle[key] = keep
+            else:
+                del self.idle[key]
+
+    def close_all(self):
+        self.lock.acquire()
+        try:
+            for conns in self.idle.values():
+                for conn, last_used in conns:
+                    self.close(conn)
+            self.idle = {}
+        finally:
+            self.lock.release()
+
+
+class FTPPool(ConnectionPool):
+    """
+    Authenticated FTP sessions of a list, checked with NOOP before being
+    reused and dropped after mlist.ftp_pool_idle_timeout seconds of
+    inactivity.
+    """
+
+    def key(self, mlist):
+        return ftp_pool_key(mlist)
+
+    def connect(self, mlist):
+        return ftp_connect(mlist)
+
+    def check(self, ftp):
+        try:
+            ftp.voidcmd('NOOP')
+            debug('ftp session reused')
+            return True
+        except ftplib.all_errors:
+            debug('ftp session dead, dropped')
+            ftp.close()
+            return False
+
+    def close(self, ftp):
+        ftp_close(ftp)
+
+    def idle_timeout(self, mlist):
+        return getattr(mlist, 'ftp_pool_idle_timeout', FTP_POOL_IDLE_TIMEOUT)
+
+
+class HTTPPool(ConnectionPool):
+    """
+    Keep-alive HTTP(S) connections, for a base url. There is no cheap way to
+    check them, a request failing on a reused connection is retried once
+    on a new one by http_request().
+    """
+
+    # the targets are (base url, (connect, transfer) timeouts)
+
+    def key(self, target):
+        scheme, netloc = urlparse.urlsplit(target[0])[:2]
+        return scheme, netloc
+
+    def connect(self, target):
+        scheme, netloc = self.key(target)
+        connect_timeout, transfer_timeout = target[1]
+        debug('http connect to %s://%s', scheme, netloc)
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(netloc, timeout=connect_timeout)
+        else:
+            conn = httplib.HTTPConnection(netloc, timeout=connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(transfer_timeout)
+        return conn
+
+    def idle_timeout(self, target):
+        return HTTP_POOL_IDLE_TIMEOUT
+
+# connections shared by all the lists served by this runner process
+ftp_pool = FTPPool()
+http_pool = HTTPPool()
+
+class MappedFile:
+    """
+    A file to upload, memory mapped. Its readers hand buffers on the map to
+    the sockets, in blocks of mlist.upload_block_size, without Python level
+    copy of the data. The pages are usually still in the cache, as
+    spool_attachment() just wrote them. With an UploadLimiter, each block
+    waits for its share of the host bandwidth.
+    """
+
+    def __init__(self, path, blocksize=UPLOAD_BLOCK_SIZE, limiter=None):
+        self.blocksize = blocksize
+        self.limiter = limiter
+        self.map = None
+        fp = open(path, 'rb')
+        try:
+            self.size = os.fstat(fp.fileno()).st_size
+            # an empty file can't be mapped
+            if self.size:
+                self.map = mmap.mmap(fp.fileno(), self.size,
+                                     access=mmap.ACCESS_READ)
+        finally:
+            # the map keeps the file open
+            fp.close()
+
+    def reader(self, offset=0, size=None):
+        return MappedReader(self, offset, size)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+
+
+class MappedReader:
+    # a read only file-like window on a MappedFile, whole or a part of a
+    # multipart upload. read() returns a buffer on the map of at most
+    # blocksize bytes, whatever size is asked by ftplib or httplib.
+    def __init__(self, mapped, offset, size):
+        self.mapped = mapped
+        self.offset = offset
+        if size is None:
+            size = mapped.size - offset
+        self.size = size
+        self.pos = 0
+
+    def read(self, n=-1):
+        n = min(self.mapped.blocksize, self.size - self.pos)
+        if n <= 0:
+            return ''
+        if self.mapped.limiter is not None:
+            self.mapped.limiter.take(n)
+        data = buffer(self.mapped.map, self.offset + self.pos, n)
+        self.pos += n
+        return data
+
+    def seek(self, pos, whence=0):
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+def ftp_store(ftp, fname, full_fname, blocksize=UPLOAD_BLOCK_SIZE, offset=0,
+              limiter=None):
+    # send full_fname from offset, the server keeps what it already has
+    # before it (REST)
+    mapped = MappedFile(full_fname, blocksize, limiter)
+    reader = mapped.reader(offset)
+    try:
+        ftp.storbinary('STOR ' + fname, reader, blocksize,
+                       rest=offset or None)
+    except (ftplib.error_temp, ftplib.error_perm), e:
+        if offset and not reader.pos:
+            # refused before any data was sent: no REST, or no resumed
+            # STOR (ProFTPD without AllowStoreRestart answers 451)
+            raise ResumeRefused('%s: resume refused (%s)' % (fname, e))
+        raise
+    finally:
+        mapped.close()
+
+def ftp_size(ftp, fname):
+    # size of a remote file, None if missing or SIZE is not supported
+    try:
+        ftp.voidcmd('TYPE I')
+        return ftp.size(fname)
+    except ftplib.error_perm:
+        return None
+
+def ftp_verify_hash(ftp, fname, full_fname):
+    # compare the SHA-256 of the remote file, with the HASH command of
+    # draft-bryan-ftpext-hash, raise StorageError if it differs
+    ftp.voidcmd('OPTS HASH SHA-256')
+    # 213 SHA-256 0-1234 hexdigest fname
+    remote = ftp.sendcmd('HASH ' + fname).split()[3].lower()
+    h = hashlib.sha256()
+    fp = open(full_fname, 'rb')
+    try:
+        while True:
+            data = fp.read(UPLOAD_BLOCK_SIZE)
+            if not data:
+                break
+            h.update(data)
+    finally:
+        fp.close()
+    if remote <> h.hexdigest():
+        raise StorageError('%s: remote SHA-256 differs' % fname)
+
+def get_remote_fname(mlist, full_fname):
+    # the name of the uploaded copy, also the last part of its url.
+    # The remote storage is flat, so the sub folders of a sharded layout
+    # become part of the name: 20140515/doc.pdf is uploaded as
+    # 20140515~doc.pdf. sanitize_fname() never leaves a ~, so these names
+    # can't be those of files uploaded with the flat layout.
+    root = os.path.join(mlist.archive_dir(), ATTACHMENTS_DIR)
+    fname = os.path.basename(full_fname)
+    subdir = os.path.dirname(full_fname)
+    if subdir.startswith(root + os.sep):
+        fname = subdir[len(root) + 1:].replace(os.sep, SHARD_SEP) + \
+                SHARD_SEP + fname
+    if hasattr(mlist, 'ftp_upload_prefix'):
+        fname = mlist.ftp_upload_prefix + fname
+    return fname
+
+def ftp_upload_attchment(mlist, full_fname, fname=None, limiter=None):
+    debug('uploading to %s', mlist.ftp_remote_host)
+    if fname is None:
+        fname = get_remote_fname(mlist, full_fname)
+
+    blocksize = getattr(mlist, 'upload_block_size', UPLOAD_BLOCK_SIZE)
+    tries = getattr(mlist, 'upload_tries', UPLOAD_TRIES)
+    size = os.path.getsize(full_fname)
+    # what the server kept of the file, None while unknown
+    remote_size = None
+    # cleared when the server refuses to resume the upload
+    resume = True
+    failed = False
+    ftp = None
+    while True:
+        try:
+            if ftp is None:
+                ftp, reused = ftp_pool.acquire(mlist)
+                if failed:
+                    # what the broken session left on the server
+                    remote_size = ftp_size(ftp, fname)
+            # resume after what the server kept, or start again if it
+            # makes no sense
+            offset = 0
+            if resume and remote_size and remote_size < size:
+                offset = remote_size
+                debug('resuming %s at %d', fname, offset)
+            ftp_store(ftp, fname, full_fname, blocksize, offset, limiter)
+            # check what the server really got, when it tells
+            remote_size = ftp_size(ftp, fname)
+            if remote_size is None or remote_size == size:
+                break
+        except ResumeRefused, e:
+            # send it all again, once, the session is fine
+            debug('%s, uploading again', e)
+            resume = False
+            continue
+        except ftplib.error_perm:
+            # the server refused the file, a new session won't help
+            if ftp is not None:
+                ftp_close(ftp)
+            raise
+        except ftplib.all_errors, e:
+            # the server may have dropped the pooled session since the
+            # NOOP, the connection broke during the transfer, or connecting
+            # again failed
+            if ftp is not None:
+                ftp_close(ftp)
+                ftp = None
+            failed = True
+            tries -= 1
+            if tries <= 0:
+                raise
+            debug('upload failed (%s), reconnecting', e)
+        else:
+            tries -= 1
+            if tries <= 0:
+                ftp_pool.release(mlist, ftp)
+                raise StorageError('%s: %d bytes uploaded instead of %d' %
+                                   (fname, remote_size, size))
+    if getattr(mlist, 'ftp_verify_hash', 0):
+        try:
+            ftp_verify_hash(ftp, fname, full_fname)
+        except:
+            ftp_close(ftp)
+            raise
+    ftp_pool.release(mlist, ftp)
+    debug('uploading OK')
+
+    return fname
+
+def with_ftp_session(mlist, func):
+    # call func(ftp) on a pooled session, return its result
+    ftp, reused = ftp_pool.acquire(mlist)
+    try:
+        result = func(ftp)
+    except ftplib.error_perm:
+        # an answer from the server, the session is fine
+        ftp_pool.release(mlist, ftp)
+        raise
+    except:
+        ftp_close(ftp)
+        raise
+    ftp_pool.release(mlist, ftp)
+    return result
+
+
+class StorageError(Exception):
+    """The remote storage refused a request."""
+
+
+class StorageRefused(StorageError):
+    """The remote storage answered, but refused this file (HTTP 4xx)."""
+
+
+class ResumeRefused(StorageError):
+    """The FTP server doesn't let an upload be resumed."""
+
+
+class StorageBackend:
+    """
+    Where the detached attachments are hosted, selected by
+    mlist.storage_backend. store() sends a local file under a remote name,
+    url_for() gives the public url of a remote name. errors are the
+    exceptions raised when the remote storage fails.
+    """
+
+    errors = (IOError, OSError, StorageError)
+
+    def __init__(self, mlist):
+        self.mlist = mlist
+        self.blocksize = getattr(mlist, 'upload_block_size', UPLOAD_BLOCK_SIZE)
+        self.timeouts = get_timeouts(mlist)
+
+    def store(self, full_fname, fname):
+        raise NotImplementedError
+
+    def exists(self, fname):
+        raise NotImplementedError
+
+    def delete(self, fname):
+        # remove a remote file, return False if it was not there
+        raise NotImplementedError
+
+    def delete_many(self, fnames):
+        # generate (fname, deleted) for each of fnames, the pooled
+        # connections are reused
+        for fname in fnames:
+            yield fname, self.delete(fname)
+
+    def url_for(self, fname):
+        return self.mlist.remote_http_base + fname
+
+    def host(self):
+        # the remote host, for the upload limits, None for a local storage
+        return None
+
+    def limiter(self):
+        return get_upload_limiter(self.host())
+
+    def probe(self):
+        # raise one of errors if the storage is still down
+        self.exists('.attachmentmove-probe')
+
+
+class FTPBackend(StorageBackend):
+    """
+    FTP with TLS when available, the historical backend, see the ftp_*
+    list settings.
+    """
+
+    errors = ftplib.all_errors + (OSError, StorageError)
+
+    def store(self, full_fname, fname):
+        ftp_upload_attchment(self.mlist, full_fname, fname, self.limiter())
+
+    def host(self):
+        return self.mlist.ftp_remote_host
+
+    def exists(self, fname):
+        def size(ftp):
+            ftp.voidcmd('TYPE I')
+            try:
+                ftp.size(fname)
+                return True
+            except ftplib.error_perm:
+                return False
+        return with_ftp_session(self.mlist, size)
+
+    def delete(self, fname):
+        def delete(ftp):
+            try:
+                ftp.delete(fname)
+                return True
+            except ftplib.error_perm:
+                return False
+        return with_ftp_session(self.mlist, delete)
+
+    def delete_many(self, fnames):
+        # all on the same session, which stays out of the pool meanwhile
+        ftp, reused = ftp_pool.acquire(self.mlist)
+        try:
+            for fname in fnames:
+                try:
+                    ftp.delete(fname)
+                    deleted = True
+                except ftplib.error_perm:
+                    deleted = False
+                yield fname, deleted
+        except:
+            ftp_close(ftp)
+            raise
+        ftp_pool.release(self.mlist, ftp)
+
+
+class LocalBackend(StorageBackend):
+    """
+    A folder of the mailman server published by the web server,
+    mlist.local_storage_dir, served as mlist.remote_http_base. Files are
+    hard linked there when possible, copied otherwise.
+    """
+
+    def path(self, fname):
+        return os.path.join(self.mlist.local_storage_dir, fname)
+
+    def store(self, full_fname, fname):
+        path = self.path(fname)
+        makedirs(os.path.dirname(path))
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            os.link(full_fname, tmp)
+        except OSError, e:
+            # other file system, or no hard link allowed
+            debug('link failed (%s), copying', e)
+            shutil.copyfile(full_fname, tmp)
+        os.rename(tmp, path)
+
+    def exists(self, fname):
+        return os.path.exists(self.path(fname))
+
+    def delete(self, fname):
+        try:
+            os.unlink(self.path(fname))
+            return True
+        except OSError, e:
+            if e.errno <> errno.ENOENT: raise
+            return False
+
+
+def http_request(base, method, path, body=None, headers={}, timeouts=None):
+    """
+    Send a request on a pooled keep-alive connection to the host of the
+    url base. A failure on a reused connection, probably closed by the
+    server meanwhile, is retried once on a new one. Return the response
+    status, headers (lower case names) and body.
+    """
+    if timeouts is None:
+        timeouts = (REMOTE_CONNECT_TIMEOUT, REMOTE_TRANSFER_TIMEOUT)
+    target = (base, timeouts)
+    for attempt in (0, 1):
+        conn, reused = http_pool.acquire(target)
+        try:
+            if hasattr(body, 'seek'):
+                body.seek(0)
+            conn.request(method, path, body, headers)
+            resp = conn.getresponse()
+            data = resp.read()
+        except (httplib.HTTPException, socket.error), e:
+            conn.close()
+            if reused and not attempt:
+                debug('pooled http connection failed (%s), reconnecting', e)
+                continue
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            http_pool.release(target, conn)
+        return resp.status, dict(resp.getheaders()), data
+
+def check_status(status, data, method, path):
+    # raise StorageError for a non 2xx answer, StorageRefused for 4xx
+    if status / 100 == 4:
+        raise StorageRefused('%s %s: %d %s' % (method, path, status,
+                                               data[:200]))
+    if status / 100 <> 2:
+        raise StorageError('%s %s: %d %s' % (method, path, status, data[:200]))
+
+
+class HTTPBackend(StorageBackend):
+    """
+    HTTP PUT, for a WebDAV server for example: files are PUT under
+    mlist.http_put_url, with basic authentication if mlist.http_put_user
+    and mlist.http_put_pass are set. Connections are kept alive.
+    """
+
+    errors = (IOError, OSError, StorageError, socket.error,
+              httplib.HTTPException)
+
+    def __init__(self, mlist):
+        StorageBackend.__init__(self, mlist)
+        self.base = mlist.http_put_url
+        self.headers = {}
+        if hasattr(mlist, 'http_put_user'):
+            credentials = '%s:%s' % (mlist.http_put_user, mlist.http_put_pass)
+            self.headers['Authorization'] = 'Basic ' + \
+                binascii.b2a_base64(credentials).strip()
+
+    def path(self, fname):
+        return urlparse.urlsplit(self.base)[2] + urllib.quote(fname)
+
+    def host(self):
+        return urlparse.urlsplit(self.base).hostname
+
+    def request(self, method, fname, body=None, headers={}):
+        h = self.headers.copy()
+        h.update(headers)
+        return http_request(self.base, method, self.path(fname), body, h,
+                            self.timeouts)
+
+    def store(self, full_fname, fname):
+        # PUT can't resume, a failed upload is sent again from the start
+        mapped = MappedFile(full_fname, self.blocksize, self.limiter())
+        try:
+            retry(self.mlist, self.errors, self.put, fname, mapped)
+        finally:
+            mapped.close()
+
+    def put(self, fname, mapped):
+        status, headers, data = self.request('PUT', fname, mapped.reader(),
+            {'Content-Length': str(mapped.size),
+             'Content-Type': guess_type(fname)})
+        check_status(status, data, 'PUT', fname)
+        self.verify_size(fname, mapped.size)
+
+    def verify_size(self, fname, size):
+        # check what the server really got, when it tells: not with
+        # mlist.upload_verify_size = 0, nor to write only credentials
+        if not getattr(self.mlist, 'upload_verify_size', 1):
+            return
+        status, headers, data = self.request('HEAD', fname)
+        if status in (401, 403, 405):
+            debug('HEAD %s not allowed (%d), size not checked', fname, status)
+            return
+        check_status(status, data, 'HEAD', fname)
+        if 'content-length' in headers and \
+                int(headers['content-length']) <> size:
+            raise StorageError('%s: %s bytes stored instead of %d' %
+                               (fname, headers['content-length'], size))
+
+    def exists(self, fname):
+        status, headers, data = self.request('HEAD', fname)
+        if status == 404:
+            return False
+        check_status(status, data, 'HEAD', fname)
+        return True
+
+    def delete(self, fname):
+        status, headers, data = self.request('DELETE', fname)
+        if status == 404:
+            return False
+        check_status(status, data, 'DELETE', fname)
+        return True
+
+    def probe(self):
+        # any answer but a server error will do, write only credentials
+        # get a 403 for HEAD
+        status, headers, data = self.request('HEAD', '.attachmentmove-probe')
+        if status / 100 == 5:
+            raise StorageError('HEAD probe: %d %s' % (status, data[:200]))
+
+
+class S3Backend(HTTPBackend):
+    """
+    An S3 compatible object storage: mlist.s3_endpoint
+    ('https://s3.example.com'), mlist.s3_bucket, mlist.s3_access_key,
+    mlist.s3_secret_key and optionally mlist.s3_region and mlist.s3_acl
+    ('public-read'). Requests are signed with AWS signature version 4 and
+    files bigger than S3_MULTIPART_THRESHOLD are sent in parts.
+    """
+
+    def __init__(self, mlist):
+        StorageBackend.__init__(self, mlist)
+        self.base = mlist.s3_endpoint
+        self.region = getattr(mlist, 's3_region', 'us-east-1')
+
+    def path(self, fname):
+        # path style, works with every S3 implementation
+        return '/%s/%s' % (self.mlist.s3_bucket, urllib.quote(fname, '~'))
+
+    def sign(self, method, path, query, headers,
+             payload_hash='UNSIGNED-PAYLOAD'):
+        # AWS signature version 4, headers get the Authorization. The
+        # payload is not signed by default, not to read the files twice.
+        amzdate = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        datestamp = amzdate[:8]
+        headers['Host'] = urlparse.urlsplit(self.base)[1]
+        headers['x-amz-date'] = amzdate
+        headers['x-amz-content-sha256'] = payload_hash
+        canonical_query = '&'.join(['%s=%s' % (urllib.quote(k, '-_.~'),
+                                               urllib.quote(v, '-_.~'))
+                                    for k, v in sorted(query)])
+        names = sorted([(k.lower(), k) for k in headers.keys()])
+        canonical_headers = ''.join(['%s:%s\n' % (l, str(headers[k]).strip())
+                                     for l, k in names])
+        signed_headers = ';'.join([l for l, k in names])
+        canonical_request = '\n'.join([method, path, canonical_query,
+                                       canonical_headers, signed_headers,
+                                       payload_hash])
+        scope = '%s/%s/s3/aws4_request' % (datestamp, self.region)
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256', amzdate, scope,
+            hashlib.sha256(canonical_request).hexdigest()])
+        key = 'AWS4' + self.mlist.s3_secret_key
+        for msg in (datestamp, self.region, 's3', 'aws4_request'):
+            key = hmac.new(key, msg, hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign, hashlib.sha256).hexdigest()
+        headers['Authorization'] = (
+            'AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, '
+            'Signature=%s' % (self.mlist.s3_access_key, scope,
+                              signed_headers, signature))
+
+    def request(self, method, fname, body=None, headers={}, query=()):
+        h = headers.copy()
+        path = self.path(fname)
+        self.sign(method, path, query, h)
+        if query:
+            path += '?' + '&'.join([v and '%s=%s' % (k, urllib.quote(v))
+                                    or k for k, v in query])
+        return http_request(self.base, method, path, body, h, self.timeouts)
+
+    def store(self, full_fname, fname):
+        headers = {'Content-Type': guess_type(fname)}
+        if hasattr(self.mlist, 's3_acl'):
+            headers['x-amz-acl'] = self.mlist.s3_acl
+        mapped = MappedFile(full_fname, self.blocksize, self.limiter())
+        try:
+            if mapped.size >= S3_MULTIPART_THRESHOLD:
+                self.store_multipart(mapped, fname, headers)
+                return
+            headers['Content-Length'] = str(mapped.size)
+            retry(self.mlist, self.errors, self.put_object, fname, mapped,
+                  headers)
+        finally:
+            mapped.close()
+
+    def put_object(self, fname, mapped, headers):
+        status, h, data = self.request('PUT', fname, mapped.reader(),
+                                       headers)
+        check_status(status, data, 'PUT', fname)
+        self.verify_size(fname, mapped.size)
+
+    def store_multipart(self, mapped, fname, headers):
+        status, h, data = self.request('POST', fname, '', headers,
+                                       (('uploads', ''),))
+        check_status(status, data, 'POST', fname)
+        upload_id = re.search(r'<UploadId>(.*?)</UploadId>', data).group(1)
+        debug('multipart upload of %s: %s', fname, upload_id)
+        try:
+            etags = []
+            for offset in range(0, mapped.size, S3_MULTIPART_SIZE):
+                n = len(etags) + 1
+                part = mapped.reader(offset,
+                                     min(S3_MULTIPART_SIZE,
+                                         mapped.size - offset))
+                # only a failed part is sent again
+                etags.append(retry(self.mlist, self.errors, self.put_part,
+                                   fname, part, n, upload_id))
+            body = '<CompleteMultipartUpload>%s</CompleteMultipartUpload>' % \
+                ''.join(['<Part><PartNumber>%d</PartNumber><ETag>%s</ETag>'
+                         '</Part>' % (i + 1, etags[i])
+                         for i in range(len(etags))])
+            status, h, data = self.request('POST', fname, body,
+                {'Content-Length': str(len(body))},
+                (('uploadId', upload_id),))
+            check_status(status, data, 'POST', fname)
+            # an error can come with a 200 status
+            if '<Error>' in data:
+                raise StorageError('POST %s: %s' % (fname, data[:200]))
+            self.verify_size(fname, mapped.size)
+        except:
+            # don't leave the parts billed on the storage
+            try:
+                self.request('DELETE', fname, None, {},
+                             (('uploadId', upload_id),))
+            except self.errors:
+                pass
+            raise
+
+    def put_part(self, fname, part, n, upload_id):
+        # send a part of a multipart upload, return its ETag
+        status, h, data = self.request('PUT', fname, part,
+            {'Content-Length': str(part.size)},
+            (('partNumber', str(n)), ('uploadId', upload_id)))
+        check_status(status, data, 'PUT', fname)
+        return h['etag']
+
+def retry(mlist, errors, func, *args):
+    # call func(*args) up to mlist.upload_tries times while it raises one
+    # of errors, return its result
+    tries = getattr(mlist, 'upload_tries', UPLOAD_TRIES)
+    while True:
+        try:
+            return func(*args)
+        except errors, e:
+            tries -= 1
+            if tries <= 0:
+                raise
+            debug('%s failed (%s), retrying', func.__name__, e)
+
+def guess_type(fname):
+    return mimetypes.guess_type(fname)[0] or 'application/octet-stream'
+
+# mlist.storage_backend values. No SFTP: the standard library has no SSH,
+# a backend for it would need paramiko; an SSH server can usually publish
+# the folder of a 'local' backend mounted with sshfs instead.
+storage_backends = {
+    'ftp': FTPBackend,
+    'local': LocalBackend,
+    'http': HTTPBackend,
+    's3': S3Backend,
+    }
+
+def get_backend(mlist):
+    return storage_backends[getattr(mlist, 'storage_backend', 'ftp')](mlist)
+
+def store(backend, path, fname):
+    # backend.store() in an upload session of the host, measured, and
+    # followed by the circuit breaker. A file refused by the storage
+    # (StorageRefused, FTP 5xx) is not an outage, the breaker ignores it.
+    limiter = backend.limiter()
+    session = None
+    if limiter is not None:
+        session = limiter.acquire(os.path.getsize(path))
+    start = time.time()
+    try:
+        try:
+            backend.store(path, fname)
+        except backend.errors, e:
+            metrics.incr('upload_errors')
+            if not isinstance(e, (StorageRefused, ftplib.error_perm)):
+                CircuitBreaker(backend.mlist).failure()
+            raise
+    finally:
+        if limiter is not None:
+            limiter.release(session)
+    CircuitBreaker(backend.mlist).success()
+    metrics.timing('upload', time.time() - start)
+    metrics.incr('bytes_uploaded', os.path.getsize(path))
+
+def upload_attachments(mlist, uploads):
+    """
+    Upload the (path, remote_fname, digest) of a message, using up to
+    mlist.ftp_upload_workers threads, each with its own pooled connection,
+    the smallest files first. A failed upload doesn't stop the others, it
+    is put on the upload spool to be retried by drain_upload_spool(), so
+    its link stays valid. The digest, if not None, is recorded by
+    dedup_record() once the file is uploaded.
+    """
+    backend = get_backend(mlist)
+    breaker = CircuitBreaker(mlist)
+    errors = [None] * len(uploads)
+    jobs = Queue.Queue()
+    sizes = [(os.path.getsize(path), i)
+             for i, (path, fname, digest) in enumerate(uploads)]
+    sizes.sort()
+    for size, i in sizes:
+        jobs.put(i)
+
+    def worker():
+        while True:
+            try:
+                i = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            path, fname, digest = uploads[i]
+            if breaker.is_open():
+                # went down meanwhile, don't wait for it
+                errors[i] = StorageError('remote storage down')
+                continue
+            try:
+                store(backend, path, fname)
+            except Exception, e:
+                # a bug too must not leave a dead link, nor kill the
+                # thread before the other files: spooled as a failure
+                errors[i] = e
+                continue
+            if digest:
+                dedup_record(mlist, digest, fname)
+
+    workers = min(getattr(mlist, 'ftp_upload_workers', 1), len(uploads))
+    if workers <= 1:
+        worker()
+    else:
+        debug('uploading %d files with %d workers', len(uploads), workers)
+        threads = []
+        for n in range(workers):
+            t = threading.Thread(target=worker)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+    for i in range(len(uploads)):
+        if errors[i] is not None:
+            path, fname, digest = uploads[i]
+            syslog('error', 'AttachmentMove: upload of %s failed, queued: %s',
+                   path, errors[i])
+            enqueue_upload(mlist, path, digest)
+
+class CircuitBreaker:
+    """
+    The health of the remote storage of a list, shared by all the runner
+    processes through a state file in $DATA_DIR/attachmentmove-breaker/,
+    one per storage (backend and remote_http_base).
+
+    After BREAKER_FAILURES failed uploads in a row the breaker is open: the
+    storage is considered down and process() goes on in the degraded mode
+    of the list (mlist.remote_degraded_mode) without waiting for it:
+
+      'queue'  the uploads are queued for drain_upload_spool() (default)
+      'local'  the links go to the copy in the list archive, as returned by
+               save_attachment(), nothing is uploaded
+      'inline' nothing is detached
+
+    Every BREAKER_COOLDOWN seconds one process probes the storage in a
+    background thread, the breaker is closed when it answers again, or by
+    any successful upload (drain_upload_spool() too).
+    """
+
+    def __init__(self, mlist):
+        self.mlist = mlist
+        key = sha_new('%s %s' % (getattr(mlist, 'storage_backend', 'ftp'),
+                                 mlist.remote_http_base)).hexdigest()[:16]
+        self.path = os.path.join(mm_cfg.DATA_DIR, 'attachmentmove-breaker',
+                                 key)
+
+    def load(self):
+        try:
+            fp = open(self.path, 'rb')
+        except IOError, e:
+            if e.errno <> errno.ENOENT: raise
+            return {'failures': 0, 'opened': None, 'probed': 0}
+        try:
+            return cPickle.load(fp)
+        finally:
+            fp.close()
+
+    def update(self, func):
+        # change the state with func(state), return it
+        makedirs(os.path.dirname(self.path))
+        lock = LockFile.LockFile(self.path + '.lock')
+        lock.lock()
+        try:
+            state = self.load()
+            func(state)
+            tmp = '%s.%d.tmp' % (self.path, os.getpid())
+            fp = open(tmp, 'wb')
+            try:
+                cPickle.dump(state, fp, 1)
+            finally:
+                fp.close()
+            os.rename(tmp, self.path)
+            return state
+        finally:
+            lock.unlock()
+
+    def is_open(self):
+        state = self.load()
+        if state['opened'] is None:
+            return False
+        now = time.time()
+        if now - max(state['opened'], state['probed']) >= BREAKER_COOLDOWN:
+            # one process takes the probe
+            def claim(state):
+                if now - max(state['opened'], state['probed']) \
+                        >= BREAKER_COOLDOWN:
+                    state['probed'] = now
+                    state['prober'] = os.getpid()
+            if self.update(claim).get('prober') == os.getpid():
+                t = threading.Thread(target=self.probe)
+                t.setDaemon(True)
+                t.start()
+        return True
+
+    def probe(self):
+        backend = get_backend(self.mlist)
+        try:
+            backend.probe()
+        except backend.errors, e:
+            debug('probe of %s failed: %s', self.mlist.remote_http_base, e)
+            return
+        syslog('error', 'AttachmentMove: %s is back',
+               self.mlist.remote_http_base)
+        self.success()
+
+    def success(self):
+        # no lock nor write while all goes well
+        if self.load()['failures']:
+            def close(state):
+                state['failures'] = 0
+                state['opened'] = None
+            self.update(close)
+
+    def failure(self):
+        def fail(state):
+            state['failures'] += 1
+            if state['failures'] >= BREAKER_FAILURES \
+                    and state['opened'] is None:
+                state['opened'] = time.time()
+                syslog('error', 'AttachmentMove: %s is down, %s mode',
+                       self.mlist.remote_http_base,
+                       getattr(self.mlist, 'remote_degraded_mode', 'queue'))
+        self.update(fail)
+
+class UploadLimiter:
+    """
+    The upload limits of a remote host, shared by all the runner processes
+    of the server, set in mm_cfg.py by host name, '*' for the other hosts:
+
+      ATTACHMENTMOVE_UPLOAD_LIMITS = {
+          'ftp.example.com': {'rate': 2000000, 'sessions': 2},
+          '*': {'rate': 5000000},
+          }
+
+    'rate' is in bytes/sec for all the uploads to the host together: a
+    token bucket holding one second of rate, kept in a state file of
+    $DATA_DIR/attachmentmove-limits/. Each block sent by a MappedReader
+    takes its tokens first, and waits if the bucket is in debt, so the
+    concurrent uploads share the bandwidth block by block.
+
+    'sessions' is the number of uploads to the host at the same time, one
+    slot file each. Files bigger than UPLOAD_SMALL_SIZE can't take the last
+    free slot, a burst of big files doesn't hold the small ones. Only the
+    transfers are counted: the idle sessions kept open by the connection
+    pools of the runners are not, set mlist.ftp_pool_idle_timeout = 0 to
+    bound the connections to the host too.
+
+    The files are locked with flock(), not LockFile: the locks go away with
+    a killed process, and are cheap enough to be taken for each block.
+    """
+
+    def __init__(self, host, rate=None, sessions=None):
+        self.rate = rate
+        self.sessions = sessions
+        base = os.path.join(mm_cfg.DATA_DIR, 'attachmentmove-limits',
+                            re.sub(r'[^\w.-]', '_', host))
+        makedirs(os.path.dirname(base))
+        self.bucket = base + '.bucket'
+        self.slot = base + '.slot%d'
+
+    def take(self, n):
+        # take the tokens for n bytes, wait until the bucket covers them
+        if not self.rate:
+            return
+        fd = os.open(self.bucket, os.O_RDWR | os.O_CREAT, 0660)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            now = time.time()
+            try:
+                tokens, stamp = map(float, os.read(fd, 64).split())
+            except ValueError:
+                # a new bucket is full
+                tokens, stamp = self.rate, now
+            tokens = min(self.rate, tokens + (now - stamp) * self.rate) - n
+            os.lseek(fd, 0, 0)
+            os.ftruncate(fd, 0)
+            os.write(fd, '%f %f' % (tokens, now))
+        finally:
+            # closing unlocks
+            os.close(fd)
+        if tokens < 0:
+            # the debt is ours, the next blocks wait after it
+            time.sleep(-tokens / self.rate)
+
+    def acquire(self, size):
+        # wait for a free session for a file of size bytes, return the
+        # locked slot for release()
+        if not self.sessions:
+            return None
+        if size < UPLOAD_SMALL_SIZE:
+            # the slot kept for the small files first
+            slots = range(self.sessions - 1, -1, -1)
+        else:
+            slots = range(max(self.sessions - 1, 1))
+        while True:
+            for i in slots:
+                fd = os.open(self.slot % i, os.O_RDWR | os.O_CREAT, 0660)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except IOError, e:
+                    os.close(fd)
+                    if e.errno not in (errno.EAGAIN, errno.EACCES): raise
+            time.sleep(UPLOAD_SESSION_WAIT)
+
+    def release(self, slot):
+        if slot is not None:
+            os.close(slot)
+
+# UploadLimiter by host, None for the hosts without limits
+upload_limiters = {}
+
+def get_upload_limiter(host):
+    if host is None:
+        return None
+    if host not in upload_limiters:
+        limits = getattr(mm_cfg, 'ATTACHMENTMOVE_UPLOAD_LIMITS', {})
+        conf = limits.get(host, limits.get('*'))
+        if conf:
+            upload_limiters[host] = UploadLimiter(host, conf.get('rate'),
+                                                  conf.get('sessions'))
+        else:
+            upload_limiters[host] = None
+    return upload_limiters[host]
+
+def get_spool_dir(mlist):
+    # one spool folder per list, so withlist -a can drain them all
+    return os.path.join(mm_cfg.QUEUE_DIR, 'attachmentmove',
+                        mlist.internal_name())
+
+def write_upload_job(spooldir, job, name):
+    # write the job file atomically, a crash leaves no partial job
+    tmp = os.path.join(spooldir, name + '.tmp')
+    fp = open(tmp, 'wb')
+    try:
+        cPickle.dump(job, fp, 1)
+        fp.flush()
+        os.fsync(fp.fileno())
+    finally:
+        fp.close()
+    os.rename(tmp, os.path.join(spooldir, name + '.job'))
+
+def enqueue_upload(mlist, full_fname, digest=None):
+    # queue the upload of the file saved by save_attachment(), return the
+    # remote name it will have once drain_upload_spool() has sent it. The
+    # digest, if any, is recorded for the deduplication once uploaded.
+    spooldir = get_spool_dir(mlist)
+    makedirs(spooldir)
+    fname = get_remote_fname(mlist, full_fname)
+    now = time.time()
+    job = {'listname': mlist.internal_name(),
+           'path': full_fname,
+           'remote': fname,
+           'created': now,
+           'tries': 0,
+           'next_try': now,
+           'last_error': None,
+           'hash': digest,
+           }
+    # time first, so the spool is drained in arrival order
+    name = '%d+%s' % (now * 1000000, sha_new(full_fname).hexdigest())
+    write_upload_job(spooldir, job, name)
+    debug('upload queued: %s', name)
+    return fname
+
+def drain_upload_spool(mlist, loop=0):
+    """
+    Upload the files queued by process() when mlist.ftp_upload_async is set.
+    Failed uploads are retried later with an exponential backoff, and given
+    up after UPLOAD_MAX_TRIES, leaving a .failed job file behind.
+
+    Run it from cron for every list:
+
+      withlist -a -r Mailman.Handlers.AttachmentMove.drain_upload_spool
+
+    or as a daemon for one list, with loop=1 (it never returns, so not
+    with -a):
+
+      withlist -r Mailman.Handlers.AttachmentMove.drain_upload_spool \
+          listname 1
+
+    Only one uploader works on a spool at a time, a run finding the spool
+    locked by another one returns at once.
+    """
+    spooldir = get_spool_dir(mlist)
+    makedirs(spooldir)
+    # flock(), released with a killed uploader, unlike LockFile
+    lockfd = os.open(os.path.join(spooldir, '.lock'),
+                     os.O_RDWR | os.O_CREAT, 0660)
+    try:
+        try:
+            fcntl.flock(lockfd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES): raise
+            debug('%s is drained by another uploader', spooldir)
+            return
+        # recover jobs left in process by a crashed uploader, none can be
+        # in process under the lock
+        for f in os.listdir(spooldir):
+            if f.endswith('.bak'):
+                base = f[:-4]
+                os.rename(os.path.join(spooldir, f),
+                          os.path.join(spooldir, base + '.job'))
+        while True:
+            for f in sorted(os.listdir(spooldir)):
+                if f.endswith('.job'):
+                    upload_job(mlist, spooldir, f[:-4])
+            if not int(loop):
+                break
+            time.sleep(UPLOAD_SPOOL_SLEEP)
+    finally:
+        # closing unlocks
+        os.close(lockfd)
+        ftp_pool.close_all()
+        http_pool.close_all()
+
+def upload_job(mlist, spooldir, name):
+    jobfile = os.path.join(spooldir, name + '.job')
+    fp = open(jobfile, 'rb')
+    try:
+        job = cPickle.load(fp)
+    finally:
+        fp.close()
+    if job['next_try'] > time.time():
+        return
+    # the .bak holds the job while we work on it
+    bakfile = os.path.join(spooldir, name + '.bak')
+    os.rename(jobfile, bakfile)
+    backend = get_backend(mlist)
+    try:
+        store(backend, job['path'], job['remote'])
+    except backend.errors, e:
+        job['tries'] += 1
+        job['last_error'] = str(e)
+        if job['tries'] >= UPLOAD_MAX_TRIES:
+            syslog('error', 'AttachmentMove: giving up upload of %s: %s',
+                   job['path'], e)
+            os.rename(bakfile, os.path.join(spooldir, name + '.failed'))
+            return
+        delay = min(UPLOAD_RETRY_DELAY * 2 ** (job['tries'] - 1),
+                    UPLOAD_RETRY_MAX_DELAY)
+        job['next_try'] = time.time() + delay
+        debug('upload of %s failed (%s), retry in %ds',
+              job['path'], e, delay)
+        write_upload_job(spooldir, job, name)
+    else:
+        # jobs queued before the hash was kept have no 'hash'
+        if job.get('hash'):
+            dedup_record(mlist, job['hash'], job['remote'])
+    os.unlink(bakfile)
+
+def update_spool_paths(mlist, moved):
+    # rewrite the pending upload jobs for files moved by
+    # reshard_attachments(), moved maps old path to new path
+    spooldir = get_spool_dir(mlist)
+    if not os.path.isdir(spooldir):
+        return
+    for f in os.listdir(spooldir):
+        if f.endswith('.bak'):
+            syslog('error', 'AttachmentMove: upload job %s in process, '
+                   'not updated', f)
+        if not (f.endswith('.job') or f.endswith('.failed')):
+            continue
+        name, ext = os.path.splitext(f)
+        jobfile = os.path.join(spooldir, f)
+        fp = open(jobfile, 'rb')
+        try:
+            job = cPickle.load(fp)
+        finally:
+            fp.close()
+        if job['path'] in moved:
+            job['path'] = moved[job['path']]
+            write_upload_job(spooldir, job, name)
+            if ext <> '.job':
+                # write_upload_job() made it a .job, keep it failed
+                os.rename(os.path.join(spooldir, name + '.job'), jobfile)
+
+def upload_spool_status(mlist):
+    """
+    Print and return the queue depth, the age of the oldest job in seconds
+    and the number of failed jobs, for monitoring:
+
+      withlist -r Mailman.Handlers.AttachmentMove.upload_spool_status listname
+    """
+    spooldir = get_spool_dir(mlist)
+    depth = failed = 0
+    oldest = None
+    if os.path.isdir(spooldir):
+        for f in os.listdir(spooldir):
+            if f.endswith('.failed'):
+                failed += 1
+            elif f.endswith('.job') or f.endswith('.bak'):
+                depth += 1
+                # the name starts with the enqueue time in microseconds
+                created = int(f.split('+')[0]) / 1000000.0
+                if oldest is None or created < oldest:
+                    oldest = created
+    age = 0
+    if oldest is not None:
+        age = int(time.time() - oldest)
+    print '%s: %d queued, oldest %ds, %d failed' % (
+        mlist.internal_name(), depth, age, failed)
+    return depth, age, failed
+
+def gc_attachments(mlist, dryrun=0, rate=None):
+    """
+    Apply the retention policy of the list, to be run daily from cron:
+
+      withlist -a -r Mailman.Handlers.AttachmentMove.gc_attachments \
+        [dryrun] [rate]
+
+    mlist.local_retention_days: the local copies older than this, already
+        uploaded, are emptied. The empty file keeps the name taken, see
+        allocate_attachment_name(). None (default) keeps them. The files
+        never uploaded (remote_degraded_mode 'local') are found in the
+        index and kept, nothing is emptied without the index.
+    mlist.remote_retention_days: the remote files linked only by messages
+        older than this are deleted. None (default) keeps them.
+    mlist.remote_quota: bytes of remote files for the list, the ones of the
+        oldest messages are deleted above. None (default) for no limit.
+    mlist.retention_keep_referenced: 1 (default), a file shared by other
+        lists (attachment_dedup) is kept as long as their messages link to
+        it, whatever the quota.
+
+    The remote files are known from the attachment index, they are deleted
+    on one session of the storage backend, at most rate (GC_DELETE_RATE)
+    per second. Each one is removed from the deduplication index first, and
+    kept if a message posted meanwhile links to it. dryrun prints what
+    would be deleted.
+    """
+    dryrun = int(dryrun)
+    if rate is None:
+        rate = GC_DELETE_RATE
+    rate = float(rate)
+    days = getattr(mlist, 'local_retention_days', None)
+    if days is not None:
+        gc_local_copies(mlist, time.time() - float(days) * 24 * 3600, dryrun)
+    # the index rows added from now on are new links, see
+    # prune_remote_files()
+    last_id = index_last_id()
+    prunes = select_remote_prunes(mlist)
+    if prunes:
+        prune_remote_files(mlist, prunes, dryrun, rate, last_id)
+
+def gc_local_copies(mlist, cutoff, dryrun):
+    # empty the local copies modified before cutoff, except those waiting
+    # in the upload spool and those never uploaded, linked by the messages
+    # (remote_degraded_mode 'local'), known from the index
+    conn = get_index()
+    if conn is None:
+        print '%s: the attachment index is disabled, local copies kept' % \
+            mlist.internal_name()
+        return
+    pending = set([row[0] for row in conn.execute(
+        'SELECT path FROM attachments WHERE list = ? AND remote IS NULL '
+        'AND path IS NOT NULL', (mlist.internal_name(),))])
+    spooldir = get_spool_dir(mlist)
+    if os.path.isdir(spooldir):
+        for f in os.listdir(spooldir):
+            if os.path.splitext(f)[1] in ('.job', '.bak', '.failed'):
+                try:
+                    fp = open(os.path.join(spooldir, f), 'rb')
+                    try:
+                        pending.add(cPickle.load(fp)['path'])
+                    finally:
+                        fp.close()
+                except (IOError, EOFError, cPickle.UnpicklingError), e:
+                    # taken meanwhile
+                    debug('gc: spool %s: %s', f, e)
+    root = os.path.join(mlist.archive_dir(), ATTACHMENTS_DIR)
+    count = freed = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        # our hidden folders (.counters)
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for fname in filenames:
+            path = os.path.join(dirpath, fname)
+            if fname.startswith('.') or fname.endswith('.tmp') \
+                    or fname.startswith('attachments.lock') \
+                    or path in pending:
+                continue
+            st = os.lstat(path)
+            if not st.st_size or st.st_mtime >= cutoff:
+                continue
+            count += 1
+            # nothing is freed while the content is hard linked elsewhere,
+            # by the archive (archive_process()) or the local backend
+            if st.st_nlink == 1:
+                freed += st.st_size
+            if dryrun:
+                print 'local %s (%d bytes)' % (path, st.st_size)
+                continue
+            # a new empty file, the content may be hard linked to the
+            # local storage backend
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            open(tmp, 'w').close()
+            os.utime(tmp, (st.st_atime, st.st_mtime))
+            os.rename(tmp, path)
+    print '%s: %d local copies emptied, %d bytes freed' % (
+        mlist.internal_name(), count, freed)
+
+def select_remote_prunes(mlist):
+    """
+    Return the (url, remote name, hash) of the remote files of the list to
+    delete, according to its retention policy, from the attachment index.
+    """
+    days = getattr(mlist, 'remote_retention_days', None)
+    quota = getattr(mlist, 'remote_quota', None)
+    if days is None and quota is None:
+        return []
+    conn = get_index()
+    if conn is None:
+        syslog('error', 'AttachmentMove: %s: remote retention needs the '
+               'attachment index', mlist.internal_name())
+        return []
+    keep_referenced = getattr(mlist, 'retention_keep_referenced', 1)
+    name = mlist.internal_name()
+    # a remote file is known by its url, the same name may exist on other
+    # storages. All the messages linking to it, from any list, count.
+    rows = conn.execute("""
+        SELECT url, MAX(remote), MAX(hash), MAX(size), MAX(date),
+               MAX(CASE WHEN list = ? THEN date END), SUM(list <> ?)
+        FROM attachments
+        WHERE url IN (SELECT url FROM attachments
+                      WHERE list = ? AND pruned IS NULL
+                      AND remote IS NOT NULL AND remote <> 'disabled')
+        GROUP BY url""", (name, name, name)).fetchall()
+    prunes = []
+    kept = []
+    cutoff = None
+    if days is not None:
+        cutoff = time.time() - float(days) * 24 * 3600
+    for url, remote, digest, size, newest, own_newest, others in rows:
+        if not keep_referenced:
+            newest = own_newest
+        if cutoff is not None and newest < cutoff:
+            prunes.append((url, remote, digest))
+        else:
+            kept.append((own_newest, size, others, url, remote, digest))
+    if quota is not None:
+        total = sum([k[1] for k in kept])
+        # the oldest first
+        kept.sort()
+        for own_newest, size, others, url, remote, digest in kept:
+            if total <= quota:
+                break
+            if others and keep_referenced:
+                continue
+            prunes.append((url, remote, digest))
+            total -= size
+    return prunes
+
+def prune_remote_files(mlist, prunes, dryrun, rate, last_id):
+    # delete the remote files, mark them in the index and forget them in
+    # the deduplication index. last_id is the last index row before the
+    # selection, the files linked by newer rows are kept
+    if dryrun:
+        for url, remote, digest in prunes:
+            print 'remote %s' % url
+        print '%s: %d remote files to delete' % (mlist.internal_name(),
+                                                 len(prunes))
+        return
+    backend = get_backend(mlist)
+    conn = get_index()
+    byname = dict([(remote, (url, digest))
+                   for url, remote, digest in prunes])
+    kept = []
+
+    def unlinked():
+        # generate the files to delete, each checked just before
+        for url, remote, digest in prunes:
+            # no new message links to it by deduplication from now on
+            if digest and dedup_lookup(mlist, digest) == remote:
+                os.unlink(get_dedup_entry(mlist, digest))
+            else:
+                digest = None
+            # but one may have since the selection
+            if conn.execute('SELECT 1 FROM attachments WHERE url = ? '
+                            'AND id > ? LIMIT 1', (url, last_id)).fetchone():
+                debug('gc: %s linked again, kept', remote)
+                if digest:
+                    dedup_record(mlist, digest, remote)
+                kept.append(remote)
+                continue
+            yield remote
+
+    count = 0
+    next_time = time.time()
+    try:
+        for remote, deleted in backend.delete_many(unlinked()):
+            url, digest = byname[remote]
+            conn.execute('UPDATE attachments SET pruned = ? WHERE url = ?',
+                         (int(time.time()), url))
+            conn.commit()
+            if deleted:
+                count += 1
+            debug('gc: %s deleted: %s', remote, deleted)
+            # paced, not bursts
+            next_time = max(next_time + 1.0 / rate, time.time())
+            time.sleep(max(0, next_time - time.time()))
+    except backend.errors, e:
+        syslog('error', 'AttachmentMove: %s: remote gc stopped: %s',
+               mlist.internal_name(), e)
+    print '%s: %d remote files deleted, %d linked again and kept' % (
+        mlist.internal_name(), count, len(kept))
+
+def read_mbox(fp):
+    """
+    Generate the (unixfrom, text, end offset) of the messages of a mbox
+    file, from its current position, one message in memory at a time.
+    A message starts with a From_ line at the beginning of the file or
+    after a blank line.
+    """
+    unixfrom = fp.readline()
+    lines = []
+    blank = False
+    while unixfrom:
+        line = fp.readline()
+        if not line or (blank and line.startswith('From ')):
+            yield unixfrom, ''.join(lines), fp.tell() - len(line)
+            unixfrom = line
+            lines = []
+        else:
+            lines.append(line)
+        blank = line in ('\n', '\r\n')
+
+# the list processed by the retro_process() workers, inherited at fork
+retro_mlist = None
+
+def retro_message(args):
+    # process one archived message, return its new mbox text, or None if
+    # it is unchanged
+    unixfrom, text = args
+    mlist = retro_mlist
+    try:
+        msg = email.message_from_string(text, Message.Message)
+        msg.set_unixfrom(unixfrom.rstrip('\r\n'))
+        if not get_policy(mlist).select(msg):
+            return None
+        # links to the copies already hosted for the whole archive
+        msg = process(mlist, msg, {'attachment_dedup': 1})
+        fp = StringIO()
+        Generator(fp, mangle_from_=True).flatten(msg, unixfrom=True)
+        text = fp.getvalue()
+    except Exception, e:
+        # leave it as it is
+        syslog('error', 'AttachmentMove: retro_process %s %s: %s',
+               mlist.internal_name(), unixfrom.strip(), e)
+        return None
+    # keep the blank line separating the messages
+    if not text.endswith('\n'):
+        text += '\n'
+    if not text.endswith('\n\n'):
+        text += '\n'
+    return text
+
+def write_retro_checkpoint(path, state):
+    fp = open(path + '.tmp', 'wb')
+    try:
+        cPickle.dump(state, fp, 1)
+    finally:
+        fp.close()
+    os.rename(path + '.tmp', path)
+
+def retro_process(mlist, mbox=None, workers=None):
+    """
+    Detach the attachments of the messages already archived in the mbox
+    of the list (mlist.ArchiveFileName() by default), with the settings of
+    the list, to reclaim disk space:
+
+      withlist -l -r Mailman.Handlers.AttachmentMove.retro_process \
+        listname [mbox] [workers]
+
+    The messages are processed by workers processes (the CPU count by
+    default), deduplicated across the whole archive (attachment_dedup is
+    forced for them, the list is not changed), and written to <mbox>.retro.mbox which replaces the mbox at
+    the end. The progress is saved in <mbox>.retro after each batch of
+    RETRO_BATCH_SIZE messages, run it again to resume an interrupted run.
+    Keep the list locked (-l), the messages archived meanwhile would be
+    lost when the mbox is replaced.
+    """
+    global retro_mlist
+    if mbox is None:
+        mbox = mlist.ArchiveFileName()
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = int(workers)
+    checkpoint = mbox + '.retro'
+    output = checkpoint + '.mbox'
+    retro_mlist = mlist
+
+    state = {'offset': 0, 'outsize': 0, 'messages': 0, 'rewritten': 0}
+    try:
+        fp = open(checkpoint, 'rb')
+        try:
+            state = cPickle.load(fp)
+        finally:
+            fp.close()
+        print 'resuming after %(messages)d messages' % state
+    except IOError, e:
+        if e.errno <> errno.ENOENT: raise
+
+    src = open(mbox, 'rb')
+    src.seek(state['offset'])
+    # a message starts there, unless all was processed
+    if state['offset'] and src.read(5) not in ('From ', ''):
+        src.close()
+        print '%s has changed since %s was written, remove it to restart' % (
+            mbox, checkpoint)
+        return
+    src.seek(state['offset'])
+    if state['outsize']:
+        out = open(output, 'r+b')
+        out.truncate(state['outsize'])
+        out.seek(state['outsize'])
+    else:
+        out = open(output, 'wb')
+
+    pool = None
+    if workers > 1:
+        # create the index before the fork, so that the workers don't race
+        # on it, each opens its own connection (see get_index())
+        get_index()
+        pool = multiprocessing.Pool(workers)
+    start = time.time()
+    try:
+        messages = read_mbox(src)
+        while True:
+            # a bounded batch, the mbox may not fit in memory
+            batch = []
+            for unixfrom, text, offset in messages:
+                batch.append((unixfrom, text))
+                if len(batch) >= RETRO_BATCH_SIZE:
+                    break
+            if not batch:
+                break
+            if pool:
+                results = pool.map(retro_message, batch)
+            else:
+                results = map(retro_message, batch)
+            for (unixfrom, text), result in zip(batch, results):
+                if result is None:
+                    out.write(unixfrom + text)
+                else:
+                    out.write(result)
+                    state['rewritten'] += 1
+            out.flush()
+            os.fsync(out.fileno())
+            state['messages'] += len(batch)
+            state['offset'] = offset
+            state['outsize'] = out.tell()
+            write_retro_checkpoint(checkpoint, state)
+            debug('retro_process: %(messages)d messages', state)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        out.close()
+        src.close()
+
+    insize = os.path.getsize(mbox)
+    os.rename(output, mbox)
+    os.unlink(checkpoint)
+    print '%s: %d messages, %d rewritten, %d -> %d bytes in %ds' % (
+        mlist.internal_name(), state['messages'], state['rewritten'],
+        insize, state['outsize'], time.time() - start)
+
+class Metrics:
+    """
+    Counters and per stage timers of this runner process, exported by
+    flush() at the end of each message, if configured in mm_cfg.py:
+
+    ATTACHMENTMOVE_METRICS_FILE: a Prometheus text file, rewritten every
+        METRICS_FILE_INTERVAL seconds, %(pid)d is replaced by the process id
+    ATTACHMENTMOVE_STATSD: 'host:port' of a StatsD server, receiving the
+        new values of each message as UDP lines
+
+    Stages: process (the whole handler), scan (finding the parts to detach),
+    sanitize (file name), save (decoding to disk), connect (to the remote
+    storage, login included), upload, rewrite (footers).
+    """
+
+    def __init__(self):
+        # name -> value
+        self.counters = {}
+        # stage -> [count, total seconds]
+        self.timers = {}
+        # StatsD lines not sent yet
+        self.pending = []
+        self.written = 0
+        # upload workers count too
+        self.lock = threading.Lock()
+        self.statsd = None
+        address = getattr(mm_cfg, 'ATTACHMENTMOVE_STATSD', None)
+        if address:
+            host, port = address.split(':')
+            self.statsd = (host, int(port))
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.path = getattr(mm_cfg, 'ATTACHMENTMOVE_METRICS_FILE', None)
+
+    def incr(self, name, value=1):
+        self.lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + value
+            if self.statsd:
+                self.pending.append('attachmentmove.%s:%d|c' % (name, value))
+        finally:
+            self.lock.release()
+
+    def timing(self, stage, seconds):
+        self.lock.acquire()
+        try:
+            timer = self.timers.setdefault(stage, [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            if self.statsd:
+                self.pending.append('attachmentmove.%s:%.3f|ms' %
+                                    (stage, seconds * 1000))
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        if self.statsd and self.pending:
+            self.lock.acquire()
+            try:
+                lines, self.pending = self.pending, []
+            finally:
+                self.lock.release()
+            try:
+                self.sock.sendto('\n'.join(lines), self.statsd)
+            except socket.error, e:
+                debug('statsd: %s', e)
+        if self.path and time.time() - self.written > METRICS_FILE_INTERVAL:
+            self.write(self.path % {'pid': os.getpid()})
+
+    def write(self, path):
+        # Prometheus text format, written atomically
+        self.written = time.time()
+        lines = []
+        self.lock.acquire()
+        try:
+            for name in sorted(self.counters.keys()):
+                lines.append('# TYPE attachmentmove_%s_total counter' % name)
+                lines.append('attachmentmove_%s_total %d' %
+                             (name, self.counters[name]))
+            lines.append('# TYPE attachmentmove_stage_seconds summary')
+            for stage in sorted(self.timers.keys()):
+                count, total = self.timers[stage]
+                lines.append('attachmentmove_stage_seconds_count'
+                             '{stage="%s"} %d' % (stage, count))
+                lines.append('attachmentmove_stage_seconds_sum'
+                             '{stage="%s"} %.6f' % (stage, total))
+        finally:
+            self.lock.release()
+        tmp = path + '.tmp'
+        try:
+            fp = open(tmp, 'w')
+            try:
+                fp.write('\n'.join(lines) + '\n')
+            finally:
+                fp.close()
+            os.rename(tmp, path)
+        except (IOError, OSError), e:
+            syslog('error', 'AttachmentMove: metrics file %s: %s', path, e)
+
+# the metrics of this runner process
+metrics = Metrics()
+
+def debug_on(msg, *args, **kws):
+    syslog.write_ex('debug', msg, args, kws)
+
+def debug_off(msg, *args, **kws):
+    # formats nothing
+    pass
+
+# debug() is debug_on() while mlist.debug = 1, see process()
+debug = debug_off
+
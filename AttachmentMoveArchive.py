@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: et sw=4 ts=4 sts=4:
+#
+# This script is opensource and can be found here:
+# https://github.com/Sylvain303/mailman-AttachmentMove
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+""" Companion handler of AttachmentMove
+
+Put it in place of ToArchive in the pipeline: the attachments detached by
+AttachmentMove are hard linked in the list archive, under attachments/ as
+Scrubber does, instead of being decoded and written again, and the archived
+copy of the message links to them.
+
+See AttachmentMove.archive_process() and README.md.
+"""
+
+from Mailman.Handlers.AttachmentMove import archive_process as process
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Benchmark of the AttachmentMove handler, outside of mailman's qrunner.
+#
+# Runs process() over a generated corpus, with a stand-in list, and reports
+# the messages/sec, the p50/p99 latency and the peak memory of the process.
+# The attachments are stored under a temporary folder, the upload goes to
+# the 'local' storage backend by default, or to an FTP server (--ftp), or is
+# skipped (--no-upload).
+#
+# Usage, from the mailman folder so that the Mailman package is importable:
+#   cd /usr/lib/mailman
+#   python /path/to/benchmark.py -n 500
+#   python /path/to/benchmark.py -n 200 --max-size 5000000 --ftp 127.0.0.1:2121
+#
+# --stream generates and processes one message at a time instead of
+# building the whole corpus first, and reports how much the resident memory
+# grows during each process() call (Linux only, it reads /proc/self):
+#   python /path/to/benchmark.py -n 20 --stream --max-attachments 2 \
+#       --mean-size 20000000 --max-size 50000000
+#
+# --prepopulate fills the attachment folder with N copies of a popular
+# name before the run, and every attachment gets that name (--name), to
+# measure the time spent finding a free name:
+#   python /path/to/benchmark.py -n 200 --prepopulate 20000 --name document.pdf
+#
+# The same --seed gives the same corpus, to compare two versions of the
+# handler. The versions without storage backends can only upload by FTP,
+# to port 21, compare them with --no-upload (or --ftp HOST:21):
+#   python benchmark.py --no-upload --handler /path/to/old/AttachmentMove.py
+#   python benchmark.py --no-upload --handler /path/to/new/AttachmentMove.py
+
+import sys
+import os
+import time
+import random
+import resource
+import shutil
+import tempfile
+import imp
+import mimetypes
+from optparse import OptionParser
+
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.application import MIMEApplication
+from email.mime.image import MIMEImage
+from email.mime.message import MIMEMessage
+import email
+
+# body charsets, with a sample text and attachment name for each
+CHARSETS = [
+    ('us-ascii', u'Hello, please find the document attached.', u'document'),
+    ('utf-8', u'Bonjour, voilà le compte rendu de la réunion.',
+     u'compte rendu réunion'),
+    ('iso-8859-1', u'Hallo, anbei die Präsentation für Jürgen.',
+     u'Präsentation Jürgen'),
+    ('iso-8859-15', u'Hola, el informe está adjunto, 5 €.', u'informe año'),
+]
+
+ATTACHMENT_TYPES = [
+    ('application', 'pdf', 'pdf'),
+    ('application', 'octet-stream', 'bin'),
+    ('application', 'vnd.oasis.opendocument.text', 'odt'),
+    ('image', 'jpeg', 'jpg'),
+]
+
+
+class BenchList:
+    """
+    The attributes and methods of a MailList used by the handler.
+    """
+    internal_name_ = 'benchmark'
+    preferred_language = 'en'
+    remote_http_base = 'http://localhost/attachments/'
+    ftp_upload_prefix = ''
+    # the FTP settings of the versions without storage backends, --ftp
+    # sets them
+    ftp_remote_host = 'localhost'
+    ftp_remote_login = 'anonymous'
+    ftp_remote_pass = 'bench@'
+    debug = 0
+
+    def __init__(self, dir):
+        self.dir = dir
+
+    def internal_name(self):
+        return self.internal_name_
+
+    def archive_dir(self):
+        return self.dir
+
+    def GetBaseArchiveURL(self):
+        return 'http://localhost/pipermail/benchmark/'
+
+
+def make_attachment(rnd, i, size, charset, name=None):
+    maintype, subtype, ext = rnd.choice(ATTACHMENT_TYPES)
+    if name:
+        ctype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        maintype, subtype = ctype.split('/')
+    # random data, as compressed documents are, so that it is encoded in
+    # base64 as in real messages
+    data = os.urandom(size)
+    if maintype == 'image':
+        part = MIMEImage(data, subtype)
+    else:
+        part = MIMEApplication(data, subtype)
+    if not name:
+        name = u'%s %d.%s' % (CHARSETS[charset][2], i, ext)
+    part.add_header('Content-Disposition', 'attachment',
+                    filename=('utf-8', '', name.encode('utf-8')))
+    return part
+
+
+def make_body(rnd, charset, html_size):
+    cset, text, name = CHARSETS[charset]
+    plain = MIMEText(text.encode(cset), 'plain', cset)
+    if not html_size:
+        return plain
+    para = u'<p>%s</p>\n' % text
+    html = u'<html><head><title>bench</title></head><body>\n%s</body></html>' \
+           % (para * (html_size / len(para) + 1))
+    alt = MIMEMultipart('alternative')
+    alt.attach(plain)
+    alt.attach(MIMEText(html.encode(cset), 'html', cset))
+    if rnd.random() < 0.3:
+        # an embedded picture, which stays in the message
+        related = MIMEMultipart('related')
+        related.attach(alt.get_payload()[1])
+        image = MIMEImage(os.urandom(2000), 'png')
+        image['Content-ID'] = '<logo@bench>'
+        related.attach(image)
+        alt.set_payload([plain, related])
+    return alt
+
+
+def make_message(rnd, n, opts):
+    """
+    One message, varying the attachment count, size, nesting depth (a
+    forwarded message inside a message), charset and html size.
+    """
+    charset = rnd.randrange(len(CHARSETS))
+    html_size = rnd.choice([0, 1000, opts.max_html / 10, opts.max_html])
+    msg = MIMEMultipart()
+    msg.attach(make_body(rnd, charset, html_size))
+    count = rnd.randint(0, opts.max_attachments)
+    for i in range(count):
+        # mostly small files, a few big ones
+        size = min(int(rnd.expovariate(1.0 / opts.mean_size)) + 1,
+                   opts.max_size)
+        msg.attach(make_attachment(rnd, i, size, charset, opts.name))
+    outer = msg
+    for depth in range(rnd.randint(0, opts.max_depth)):
+        fwd = MIMEMultipart()
+        fwd.attach(MIMEText('Forwarded message below.', 'plain', 'us-ascii'))
+        fwd.attach(MIMEMessage(outer))
+        outer = fwd
+    outer['From'] = 'bench%d@example.com' % (n % 50)
+    outer['To'] = 'benchmark@lists.example.com'
+    outer['Subject'] = 'benchmark message %d' % n
+    outer['Message-ID'] = '<bench.%d.%d@example.com>' % (opts.seed, n)
+    outer['Date'] = email.Utils.formatdate(1400000000 + n * 60)
+    return outer.as_string()
+
+
+def make_corpus(opts):
+    rnd = random.Random(opts.seed)
+    return [make_message(rnd, n, opts) for n in range(opts.messages)]
+
+
+def prepopulate(dir, name, count):
+    """
+    Create count empty files named as the handler names the copies of an
+    attachment called name: name, then base-0001.ext, base-0002.ext...
+    without the hints of the newer handlers, as a folder filled by an older
+    version. name has to be a sanitized name, plain ASCII without spaces.
+    """
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+    base, ext = os.path.splitext(name)
+    for n in range(count):
+        if n:
+            fname = '%s-%04d%s' % (base, n, ext)
+        else:
+            fname = name
+        open(os.path.join(dir, fname), 'w').close()
+
+
+def time_calls(module, name, timings):
+    # replace module.name by a wrapper appending the time of each call to
+    # timings
+    func = getattr(module, name)
+    def timed(*args, **kw):
+        t = time.time()
+        try:
+            return func(*args, **kw)
+        finally:
+            timings.append(time.time() - t)
+    setattr(module, name, timed)
+
+
+def reset_peak_rss():
+    # restart the peak resident set size of the process from the current
+    # one, Linux 4.0 and later. False if it isn't supported
+    try:
+        fp = open('/proc/self/clear_refs', 'w')
+        try:
+            fp.write('5')
+        finally:
+            fp.close()
+    except IOError:
+        return False
+    return True
+
+
+def read_rss():
+    # (current, peak) resident set size in kB
+    values = {}
+    for line in open('/proc/self/status'):
+        key, sep, value = line.partition(':')
+        if key in ('VmRSS', 'VmHWM'):
+            values[key] = int(value.split()[0])
+    return values['VmRSS'], values['VmHWM']
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def isolate(tmp):
+    """
+    Keep the benchmark out of the site state: no rows in the attachment
+    index, no metrics export, and the dedup, circuit breaker, upload limits
+    and upload spool files under tmp. Before loading the handler, which
+    reads some of it at import.
+    """
+    from Mailman import mm_cfg
+    mm_cfg.ATTACHMENTMOVE_INDEX = None
+    mm_cfg.ATTACHMENTMOVE_METRICS_FILE = None
+    mm_cfg.ATTACHMENTMOVE_STATSD = None
+    mm_cfg.DATA_DIR = os.path.join(tmp, 'data')
+    mm_cfg.QUEUE_DIR = os.path.join(tmp, 'qfiles')
+
+
+def load_handler(path):
+    if path:
+        return imp.load_source('AttachmentMove', path)
+    from Mailman.Handlers import AttachmentMove
+    return AttachmentMove
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--messages', type='int', default=200)
+    parser.add_option('--seed', type='int', default=1)
+    parser.add_option('--max-attachments', type='int', default=4)
+    parser.add_option('--mean-size', type='int', default=200000,
+                      help='mean attachment size in bytes')
+    parser.add_option('--max-size', type='int', default=20000000)
+    parser.add_option('--max-depth', type='int', default=2,
+                      help='levels of forwarded messages')
+    parser.add_option('--max-html', type='int', default=200000,
+                      help='biggest html body in bytes')
+    parser.add_option('--handler', help='AttachmentMove.py to measure, '
+                      'default Mailman.Handlers.AttachmentMove')
+    parser.add_option('--ftp', metavar='HOST:PORT',
+                      help='upload to this FTP server')
+    parser.add_option('--ftp-login', default='anonymous')
+    parser.add_option('--ftp-pass', default='bench@')
+    parser.add_option('--no-upload', action='store_true')
+    parser.add_option('--keep', action='store_true',
+                      help="don't remove the stored attachments")
+    parser.add_option('--name', help='the file name of every attachment')
+    parser.add_option('--prepopulate', type='int', default=0, metavar='N',
+                      help='create N copies of --name in the attachment '
+                      'folder before the run')
+    parser.add_option('--stream', action='store_true',
+                      help='generate the messages one at a time and report '
+                      'the memory growth of each process() call')
+    opts, args = parser.parse_args()
+    if opts.prepopulate and not opts.name:
+        parser.error('--prepopulate needs --name')
+    if opts.stream and not reset_peak_rss():
+        parser.error('--stream needs /proc/self/clear_refs (Linux 4.0)')
+
+    # the Mailman package of the current folder
+    sys.path.insert(0, os.getcwd())
+    tmp = tempfile.mkdtemp(prefix='attachmentmove-bench-')
+    isolate(tmp)
+    handler = load_handler(opts.handler)
+    if not hasattr(handler, 'get_backend') and not opts.no_upload \
+            and not opts.ftp:
+        shutil.rmtree(tmp, True)
+        parser.error('this handler only uploads by FTP, to port 21, use '
+                     '--no-upload or --ftp HOST:21')
+
+    if opts.stream:
+        rnd = random.Random(opts.seed)
+        corpus = (make_message(rnd, n, opts) for n in range(opts.messages))
+    else:
+        t = time.time()
+        corpus = make_corpus(opts)
+        print 'corpus: %d messages, %.1f MB, generated in %.1fs' % \
+              (len(corpus), sum(map(len, corpus)) / 1e6, time.time() - t)
+
+    mlist = BenchList(os.path.join(tmp, 'archive'))
+    if opts.ftp:
+        host, port = opts.ftp.split(':')
+        mlist.storage_backend = 'ftp'
+        mlist.ftp_remote_host = host
+        mlist.ftp_remote_port = int(port)
+        mlist.ftp_remote_login = opts.ftp_login
+        mlist.ftp_remote_pass = opts.ftp_pass
+    else:
+        mlist.storage_backend = 'local'
+        mlist.local_storage_dir = os.path.join(tmp, 'remote')
+    msgdata = {}
+    if opts.no_upload:
+        msgdata['disable_upload'] = 1
+    # the time spent finding a free name, by save_attachment() itself in
+    # the versions without allocate_attachment_name()
+    allocations = []
+    if hasattr(handler, 'allocate_attachment_name'):
+        allocator = 'allocate_attachment_name'
+    else:
+        allocator = 'save_attachment'
+    time_calls(handler, allocator, allocations)
+    if opts.prepopulate:
+        # the default flat layout
+        t = time.time()
+        prepopulate(os.path.join(mlist.archive_dir(), 'attachments-moved'),
+                    opts.name, opts.prepopulate)
+        print 'prepopulated: %d copies of %s in %.1fs' % (
+            opts.prepopulate, opts.name, time.time() - t)
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    latencies = []
+    # (kB gained during process(), message size) with --stream
+    growths = []
+    total = 0
+    elapsed = 0
+    try:
+        for text in corpus:
+            total += len(text)
+            # parsing is mailman's job, not measured
+            msg = email.message_from_string(text)
+            if opts.stream:
+                # only the parsed message is alive, as in a qrunner
+                size = len(text)
+                text = None
+                reset_peak_rss()
+                before = read_rss()[0]
+            t = time.time()
+            handler.process(mlist, msg, dict(msgdata))
+            latencies.append(time.time() - t)
+            elapsed += latencies[-1]
+            if opts.stream:
+                growths.append((read_rss()[1] - before, size))
+            msg = None
+    finally:
+        if opts.keep:
+            print 'stored in', tmp
+        else:
+            shutil.rmtree(tmp, True)
+
+    print 'messages/sec: %.1f (%.1f MB/s)' % (len(latencies) / elapsed,
+                                             total / 1e6 / elapsed)
+    print 'latency: p50 %.2f ms, p99 %.2f ms, max %.2f ms' % (
+        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+        max(latencies) * 1000)
+    if opts.stream:
+        growth, size = max(growths)
+        print 'memory growth in process(): p50 %.1f MB, max %.1f MB ' \
+              '(message of %.1f MB)' % (
+                  percentile([g for g, s in growths], 50) / 1024.0,
+                  growth / 1024.0, size / 1e6)
+        print 'memory after the last message: %.1f MB' % (
+            read_rss()[0] / 1024.0)
+    else:
+        # ru_maxrss is in kB on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print 'peak memory: %.1f MB (%.1f MB before processing)' % (
+            peak / 1024.0, rss / 1024.0)
+    if allocations:
+        print '%s: %d calls, p50 %.2f ms, p99 %.2f ms, max %.2f ms' % (
+            allocator, len(allocations),
+            percentile(allocations, 50) * 1000,
+            percentile(allocations, 99) * 1000, max(allocations) * 1000)
+    metrics = getattr(handler, 'metrics', None)
+    if metrics:
+        for stage in sorted(metrics.timers):
+            count, seconds = metrics.timers[stage]
+            print '  %-10s %6d x %8.3f ms' % (stage, count,
+                                             seconds * 1000 / count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Fault injection test of the resumable FTP uploads of the AttachmentMove
+# handler, ftp_upload_attchment().
+#
+# A local FTP stand-in, running in a thread, breaks some of the uploads at a
+# random offset, in one of two ways:
+#   drop      the data connection is closed, 426 is answered and the control
+#             connection is closed too, as when the network goes down
+#   truncate  226 is answered, but the server kept only the beginning of
+#             the file, the handler has to notice it with SIZE
+# Each file is then compared with what the server stored, and the bytes
+# received by the server are counted: with REST, a broken upload only sends
+# the missing tail again (--no-rest makes the server refuse REST, and
+# --no-restart accepts REST but refuses the STOR which follows, as ProFTPD
+# without AllowStoreRestart: the files are sent again from the start).
+#
+# Usage, from the mailman folder so that the Mailman package is importable:
+#   cd /usr/lib/mailman
+#   python /path/to/ftp_faults.py -n 50
+#   python /path/to/ftp_faults.py -n 20 --faults 0.8 --no-rest --verify-hash
+#   python /path/to/ftp_faults.py -n 20 --no-restart
+#
+# The exit status is 1 if an upload failed or a stored file differs.
+
+import sys
+import os
+import random
+import hashlib
+import shutil
+import socket
+import tempfile
+import threading
+import SocketServer
+import imp
+from optparse import OptionParser
+
+
+class FaultyFTPHandler(SocketServer.StreamRequestHandler):
+    """
+    The few FTP commands used by the handler: passive mode, STOR with REST,
+    SIZE, and HASH (draft-bryan-ftpext-hash). No TLS, AUTH is refused so
+    the handler falls back to plain FTP.
+    """
+
+    def reply(self, line):
+        self.wfile.write(line + '\r\n')
+        self.wfile.flush()
+
+    def handle(self):
+        server = self.server
+        self.pasv = None
+        self.rest = 0
+        self.reply('220 faulty FTP stand-in')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            cmd, sep, arg = line.strip().partition(' ')
+            cmd = cmd.upper()
+            path = os.path.join(server.root, os.path.basename(arg))
+            if cmd == 'AUTH':
+                self.reply('502 no TLS here')
+            elif cmd == 'USER':
+                self.reply('331 password please')
+            elif cmd == 'PASS':
+                self.reply('230 logged in')
+            elif cmd in ('TYPE', 'NOOP', 'OPTS'):
+                self.reply('200 ok')
+            elif cmd == 'PASV':
+                self.pasv = socket.socket()
+                self.pasv.bind(('127.0.0.1', 0))
+                self.pasv.listen(1)
+                port = self.pasv.getsockname()[1]
+                self.reply('227 Entering Passive Mode (127,0,0,1,%d,%d)' %
+                           (port >> 8, port & 255))
+            elif cmd == 'REST':
+                if server.no_rest:
+                    self.reply('502 REST not implemented')
+                else:
+                    self.rest = int(arg)
+                    self.reply('350 restarting')
+            elif cmd == 'SIZE':
+                if os.path.exists(path):
+                    self.reply('213 %d' % os.path.getsize(path))
+                else:
+                    self.reply('550 no such file')
+            elif cmd == 'HASH':
+                data = open(path, 'rb').read()
+                self.reply('213 SHA-256 0-%d %s %s' % (
+                    len(data), hashlib.sha256(data).hexdigest(), arg))
+            elif cmd == 'STOR':
+                if self.rest and server.no_restart:
+                    self.rest = 0
+                    self.reply('451 %s: Append/Restart not permitted, '
+                               'try again' % arg)
+                elif not self.store(path):
+                    return
+            elif cmd == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('502 %s not implemented' % cmd)
+
+    def store(self, path):
+        # receive a file from the REST offset, return False when the
+        # control connection is dropped
+        server = self.server
+        conn, addr = self.pasv.accept()
+        self.pasv.close()
+        self.reply('150 send it')
+        if self.rest:
+            fp = open(path, 'r+b')
+            fp.seek(self.rest)
+            fp.truncate()
+        else:
+            fp = open(path, 'wb')
+        fault, cut = server.plan(os.path.basename(path), self.rest)
+        self.rest = 0
+        received = 0
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            server.count(len(data))
+            if cut is not None and received + len(data) > cut:
+                fp.write(data[:cut - received])
+                break
+            fp.write(data)
+            received += len(data)
+        fp.close()
+        conn.close()
+        if fault == 'drop':
+            self.reply('426 connection closed, transfer aborted')
+            return False
+        self.reply('226 transfer complete')
+        return True
+
+
+class FaultyFTPServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, root, rnd, faults, max_faults, no_rest, no_restart):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 FaultyFTPHandler)
+        self.root = root
+        self.rnd = rnd
+        self.faults = faults
+        self.max_faults = max_faults
+        self.no_rest = no_rest
+        self.no_restart = no_restart
+        # expected size and faults injected so far, by file name
+        self.sizes = {}
+        self.injected = {}
+        self.stats = {'drop': 0, 'truncate': 0, 'received': 0}
+        self.lock = threading.Lock()
+
+    def expect(self, fname, size):
+        self.sizes[fname] = size
+        self.injected[fname] = 0
+
+    def plan(self, fname, offset):
+        # (fault, cut): the fault to inject in this transfer, and after
+        # how many bytes, or (None, None)
+        self.lock.acquire()
+        try:
+            size = self.sizes.get(fname, 0)
+            if size - offset < 2 or self.injected[fname] >= self.max_faults \
+                    or self.rnd.random() >= self.faults:
+                return None, None
+            self.injected[fname] += 1
+            fault = self.rnd.choice(['drop', 'truncate'])
+            self.stats[fault] += 1
+            return fault, self.rnd.randint(1, size - offset - 1)
+        finally:
+            self.lock.release()
+
+    def count(self, n):
+        self.lock.acquire()
+        self.stats['received'] += n
+        self.lock.release()
+
+
+class FaultsList:
+    """
+    The attributes of a MailList used by ftp_upload_attchment().
+    """
+    internal_name_ = 'ftpfaults'
+    ftp_remote_host = '127.0.0.1'
+    ftp_remote_login = 'faults'
+    ftp_remote_pass = 'faults'
+    ftp_upload_prefix = ''
+    remote_http_base = 'http://localhost/attachments/'
+    debug = 0
+
+    def internal_name(self):
+        return self.internal_name_
+
+
+def load_handler(path):
+    # the Mailman package of the current folder
+    sys.path.insert(0, os.getcwd())
+    if path:
+        return imp.load_source('AttachmentMove', path)
+    from Mailman.Handlers import AttachmentMove
+    return AttachmentMove
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--files', type='int', default=30)
+    parser.add_option('--seed', type='int', default=1)
+    parser.add_option('--mean-size', type='int', default=2000000,
+                      help='mean file size in bytes')
+    parser.add_option('--faults', type='float', default=0.5,
+                      help='probability that a transfer is broken')
+    parser.add_option('--max-faults', type='int', default=3,
+                      help='broken transfers at most per file')
+    parser.add_option('--no-rest', action='store_true',
+                      help='the server refuses REST')
+    parser.add_option('--no-restart', action='store_true',
+                      help='the server refuses STOR after REST')
+    parser.add_option('--verify-hash', action='store_true',
+                      help='check the SHA-256 with HASH after the upload')
+    parser.add_option('--handler', help='AttachmentMove.py to test, '
+                      'default Mailman.Handlers.AttachmentMove')
+    opts, args = parser.parse_args()
+
+    handler = load_handler(opts.handler)
+    rnd = random.Random(opts.seed)
+    tmp = tempfile.mkdtemp(prefix='attachmentmove-faults-')
+    local = os.path.join(tmp, 'local')
+    remote = os.path.join(tmp, 'remote')
+    os.mkdir(local)
+    os.mkdir(remote)
+
+    server = FaultyFTPServer(remote, rnd, opts.faults, opts.max_faults,
+                             opts.no_rest, opts.no_restart)
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+
+    mlist = FaultsList()
+    mlist.ftp_remote_port = server.server_address[1]
+    # every file has to get through its faults
+    mlist.upload_tries = opts.max_faults + 1
+    mlist.ftp_verify_hash = opts.verify_hash and 1 or 0
+
+    failed = 0
+    total = 0
+    try:
+        for n in range(opts.files):
+            size = int(rnd.expovariate(1.0 / opts.mean_size)) + 1
+            fname = 'file%d.bin' % n
+            path = os.path.join(local, fname)
+            fp = open(path, 'wb')
+            fp.write(os.urandom(size))
+            fp.close()
+            total += size
+            server.expect(fname, size)
+            try:
+                handler.ftp_upload_attchment(mlist, path, fname)
+            except Exception, e:
+                print '%s (%d bytes): upload failed: %r' % (fname, size, e)
+                failed += 1
+                continue
+            stored = open(os.path.join(remote, fname), 'rb').read()
+            if stored <> open(path, 'rb').read():
+                print '%s (%d bytes): stored %d bytes, content differs' % (
+                    fname, size, len(stored))
+                failed += 1
+    finally:
+        handler.ftp_pool.close_all()
+        server.shutdown()
+        shutil.rmtree(tmp, True)
+
+    stats = server.stats
+    print 'files: %d, %.1f MB, %d failed' % (opts.files, total / 1e6, failed)
+    print 'faults: %d dropped, %d truncated' % (stats['drop'],
+                                                stats['truncate'])
+    print 'received by the server: %.1f MB, %.1f%% sent again' % (
+        stats['received'] / 1e6,
+        (stats['received'] - total) * 100.0 / max(total, 1))
+    sys.exit(failed and 1 or 0)
+
+
+if __name__ == '__main__':
+    main()